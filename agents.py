@@ -1,141 +1,741 @@
 # agents.py
 from datetime import datetime, timedelta, date # Aggiunto date
-from twilio.rest import Client
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
+import random
+import socket
+import threading
+import time
 import psycopg2
 import psycopg2.extras # Aggiunto per DictCursor
+from contextlib import contextmanager
+
+from db_pool import ConnectionPool
+from metrics import Counter, Histogram
+from notification_backends import TwilioBackend
+from sms_coalescing import coalesce_reminders, format_reminder_item, normalized_phone_sql, render_message
 
 # Carica le variabili dal file .env (se non già fatto globalmente in app.py all'avvio)
 # Dalla struttura di app.py, load_dotenv() è già chiamato lì.
 # Quindi le variabili d'ambiente dovrebbero essere disponibili.
 
+# Metriche esposte da /metrics
+DB_QUERY_SECONDS = Histogram(
+    "promem_db_query_seconds", "Durata delle operazioni di DatabaseAgent (incluso il checkout dal pool)", ["query"]
+)
+SMS_SEND_SECONDS = Histogram(
+    "promem_sms_send_seconds", "Latenza di invio di un SMS tramite il backend di notifica", ["outcome"]
+)
+ORCHESTRATOR_STAGE_SECONDS = Histogram(
+    "promem_orchestrator_stage_seconds", "Durata delle fasi di OrchestratorAgent.process_reminders", ["stage"],
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+)
+REMINDERS_TOTAL = Counter(
+    "promem_reminders_total", "Promemoria elaborati da OrchestratorAgent per esito (sent, failed, skipped, already_sent)", ["outcome"]
+)
+DELIVERY_RETRIES_TOTAL = Counter(
+    "promem_delivery_retries_total", "Promemoria reinviati dal ciclo di retry dell'outbox per esito (sent, failed, skipped)", ["outcome"]
+)
+
+# Chiave dell'advisory lock PostgreSQL che impedisce due esecuzioni sovrapposte del processo promemoria
+REMINDERS_RUN_LOCK_KEY = 720150001
+
+# Tentativi e attesa (secondi, crescente) per registrare nell'outbox un SMS già consegnato
+RECORD_SENT_ATTEMPTS = 3
+RECORD_SENT_RETRY_DELAY = 0.5
+
 class DatabaseAgent:
-    def __init__(self, db_config):
+    def __init__(self, db_config, pool=None):
         self.db_config = db_config
+        # Il pool è condiviso con app.py; se non fornito ne viene creato uno dedicato
+        self.pool = pool if pool is not None else ConnectionPool(db_config)
 
-    def _get_db_connection(self):
-        return psycopg2.connect(**self.db_config)
-
-    def get_unsent_reminders(self):
-        conn = self._get_db_connection()
-        # Usa DictCursor per accedere ai campi per nome
-        cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        cursor.execute("SELECT id, phone_number, message, date, sent FROM reminders WHERE sent = FALSE")
-        reminders = cursor.fetchall()
-        cursor.close()
-        conn.close()
+    @contextmanager
+    def _get_db_connection(self, query=None):
+        """Connessione dal pool; se query è indicata la durata finisce in promem_db_query_seconds."""
+        if query is None:
+            with self.pool.connection() as conn:
+                yield conn
+            return
+        with DB_QUERY_SECONDS.time(query=query):
+            with self.pool.connection() as conn:
+                yield conn
+
+    def claim_due_reminders(self, due_dates, worker_id, limit, lease_seconds):
+        """
+        Prende in carico fino a limit promemoria in scadenza, con un lease di lease_seconds.
+        due_dates è {data promemoria: anticipo} (vedi ReminderLogicAgent.due_dates): un promemoria è escluso
+        se l'SMS per quell'anticipo è già nell'outbox, così con più anticipi ognuno produce il suo SMS.
+        FOR UPDATE SKIP LOCKED evita che due worker prendano le stesse righe; i lease scaduti
+        (es. worker terminato a metà) tornano disponibili.
+        """
+        dates = list(due_dates)
+        offsets = [due_dates[due_date] for due_date in dates]
+        with self._get_db_connection("claim_due_reminders") as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            try:
+                cursor.execute(f"""
+                    UPDATE reminders
+                    SET claimed_by = %(worker_id)s, claimed_until = NOW() + %(lease_seconds)s * INTERVAL '1 second'
+                    -- Il filtro sulla data limita l'UPDATE alle partizioni dei giorni in scadenza
+                    WHERE date = ANY(%(dates)s) AND id IN (
+                        SELECT r.id FROM reminders r
+                        JOIN unnest(%(dates)s::date[], %(offsets)s::integer[]) AS d(due_date, lead_days) ON d.due_date = r.date
+                        WHERE r.sent = FALSE AND r.date = ANY(%(dates)s)
+                          AND (r.claimed_until IS NULL OR r.claimed_until < NOW())
+                          -- Gli invii falliti o in corso per questo anticipo sono gestiti dal ciclo di retry;
+                          -- quelli rimasti in coda ('queued', es. worker terminato prima dell'invio) tornano disponibili.
+                          -- Un SMS già consegnato passa solo per l'ultimo anticipo, per ripetere la marcatura 'sent'
+                          AND NOT EXISTS (
+                              SELECT 1 FROM sms_outbox o
+                              WHERE o.reminder_id = r.id AND o.lead_days = d.lead_days AND o.status <> 'queued'
+                                AND NOT (o.status = 'sent' AND o.lead_days = %(final_offset)s)
+                          )
+                        -- Per numero normalizzato (come coalesce_reminders): i promemoria dello stesso cliente,
+                        -- anche se scritti in formati diversi, finiscono nello stesso blocco e in un solo SMS
+                        ORDER BY {normalized_phone_sql('r.phone_number')}, r.id
+                        LIMIT %(limit)s
+                        FOR UPDATE OF r SKIP LOCKED
+                    )
+                    RETURNING id, phone_number, message, date, sent
+                """, {
+                    "worker_id": worker_id, "lease_seconds": lease_seconds, "dates": dates, "offsets": offsets,
+                    "final_offset": min(offsets), "limit": limit
+                })
+                reminders = cursor.fetchall()
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Errore durante la presa in carico dei promemoria: {e}")
+                raise
+            finally:
+                cursor.close()
         return reminders
 
-    def mark_reminder_sent(self, reminder_id):
-        conn = self._get_db_connection()
-        cursor = conn.cursor()
-        try:
-            cursor.execute("UPDATE reminders SET sent = TRUE WHERE id = %s", (reminder_id,))
-            conn.commit()
-        except Exception as e:
-            conn.rollback()
-            print(f"Errore durante l'aggiornamento del promemoria {reminder_id}: {e}")
-            # È buona pratica rilanciare l'eccezione o gestirla in modo più specifico
-            raise
-        finally:
-            cursor.close()
-            conn.close()
+    def mark_reminders_sent(self, reminder_ids):
+        """Marca come inviati più promemoria con un solo UPDATE e un solo commit. Ritorna le righe aggiornate."""
+        reminder_ids = list(reminder_ids)
+        if not reminder_ids:
+            return 0
+        with self._get_db_connection("mark_reminders_sent") as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(
+                    "UPDATE reminders SET sent = TRUE, claimed_by = NULL, claimed_until = NULL, updated_at = NOW() WHERE id = ANY(%s)",
+                    (reminder_ids,)
+                )
+                updated = cursor.rowcount
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Errore durante l'aggiornamento dei promemoria {reminder_ids}: {e}")
+                raise
+            finally:
+                cursor.close()
+        return updated
 
-class ReminderLogicAgent:
-    def should_send_reminder(self, reminder_date_param): # Rinominato per chiarezza
+    @staticmethod
+    def _delivery_arrays(deliveries):
+        """Coppie (id promemoria, anticipo) -> (array di id, array di anticipi), per unnest() in SQL."""
+        deliveries = list(deliveries)
+        return [reminder_id for reminder_id, _ in deliveries], [lead_days for _, lead_days in deliveries]
+
+    def begin_deliveries(self, deliveries, lease_seconds):
         """
-        Verifica se un promemoria deve essere inviato.
-        La logica originale era: oggi + 3 giorni == data promemoria.
+        Registra nell'outbox (sms_outbox) gli invii di un blocco, coppie (id promemoria, anticipo), in stato
+        'queued' (in coda, non ancora inviati); una riga rimasta in coda da un'esecuzione interrotta viene ripresa.
+        Ogni messaggio passa a 'sending' solo subito prima dell'invio (start_delivery).
+        Ritorna (id da inviare, id già inviati): i secondi hanno già un SMS consegnato in un'esecuzione
+        precedente (es. marcatura fallita dopo l'invio) e vanno solo marcati come inviati, senza un nuovo SMS.
         """
-        today = datetime.now().date()
+        reminder_ids, offsets = self._delivery_arrays(deliveries)
+        if not reminder_ids:
+            return [], []
+        with self._get_db_connection("begin_deliveries") as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    WITH queued AS (
+                        INSERT INTO sms_outbox (reminder_id, lead_days, status, next_attempt_at)
+                        SELECT reminder_id, lead_days, 'queued', NOW() + %(lease_seconds)s * INTERVAL '1 second'
+                        FROM unnest(%(ids)s::integer[], %(offsets)s::integer[]) AS d(reminder_id, lead_days)
+                        ON CONFLICT (reminder_id, lead_days) DO UPDATE
+                        SET next_attempt_at = EXCLUDED.next_attempt_at, updated_at = NOW()
+                        WHERE sms_outbox.status = 'queued'
+                        RETURNING reminder_id
+                    )
+                    SELECT reminder_id, 'queued' FROM queued
+                    UNION ALL
+                    SELECT o.reminder_id, o.status
+                    FROM sms_outbox o JOIN unnest(%(ids)s::integer[], %(offsets)s::integer[]) AS d(reminder_id, lead_days)
+                    USING (reminder_id, lead_days)
+                    WHERE o.status = 'sent'
+                """, {"ids": reminder_ids, "offsets": offsets, "lease_seconds": lease_seconds})
+                rows = cursor.fetchall()
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Errore durante la registrazione nell'outbox dei promemoria {reminder_ids}: {e}")
+                raise
+            finally:
+                cursor.close()
+        to_send = [reminder_id for reminder_id, status in rows if status == 'queued']
+        already_sent = [reminder_id for reminder_id, status in rows if status == 'sent']
+        return to_send, already_sent
+
+    def start_delivery(self, deliveries, lease_seconds):
+        """
+        Passa da 'queued' a 'sending' gli invii (id promemoria, anticipo) di un messaggio, subito prima dell'invio:
+        il lease di lease_seconds copre solo la chiamata al provider, non l'attesa del resto del blocco.
+        Ritorna gli id passati a 'sending'; quelli mancanti sono già stati presi da un altro processo.
+        """
+        reminder_ids, offsets = self._delivery_arrays(deliveries)
+        with self._get_db_connection("start_delivery") as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    UPDATE sms_outbox
+                    SET status = 'sending', next_attempt_at = NOW() + %s * INTERVAL '1 second', updated_at = NOW()
+                    WHERE (reminder_id, lead_days) IN (SELECT * FROM unnest(%s::integer[], %s::integer[]))
+                      AND status = 'queued'
+                    RETURNING reminder_id
+                """, (lease_seconds, reminder_ids, offsets))
+                started = [row[0] for row in cursor.fetchall()]
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Errore durante l'avvio dell'invio dei promemoria {reminder_ids}: {e}")
+                raise
+            finally:
+                cursor.close()
+        return started
+
+    def record_delivery(self, deliveries, phone_number, status, provider_sid=None, error=None,
+                        max_attempts=5, backoff_base=60, backoff_max=3600, jitter=1.0):
+        """
+        Salva l'esito di un tentativo di invio (status: sent, failed, skipped) per le coppie (id promemoria, anticipo)
+        di un messaggio nell'outbox e nel registro sms_delivery_log.
+        Dopo un fallimento il prossimo tentativo è pianificato con backoff esponenziale:
+        min(backoff_max, backoff_base * 2^tentativi) * jitter; oltre max_attempts tentativi lo stato diventa 'dead'.
+        """
+        reminder_ids, offsets = self._delivery_arrays(deliveries)
+        with self._get_db_connection("record_delivery") as conn:
+            cursor = conn.cursor()
+            try:
+                if status == 'failed':
+                    cursor.execute("""
+                        UPDATE sms_outbox
+                        SET status = CASE WHEN attempts + 1 >= %s THEN 'dead' ELSE 'failed' END,
+                            attempts = attempts + 1,
+                            last_error = %s,
+                            next_attempt_at = NOW() + LEAST(%s, %s * POWER(2, attempts)) * %s * INTERVAL '1 second',
+                            updated_at = NOW()
+                        WHERE (reminder_id, lead_days) IN (SELECT * FROM unnest(%s::integer[], %s::integer[]))
+                    """, (max_attempts, error, backoff_max, backoff_base, jitter, reminder_ids, offsets))
+                else:
+                    cursor.execute("""
+                        UPDATE sms_outbox
+                        SET status = %s, attempts = attempts + 1, provider_sid = %s, last_error = %s,
+                            next_attempt_at = NULL, updated_at = NOW()
+                        WHERE (reminder_id, lead_days) IN (SELECT * FROM unnest(%s::integer[], %s::integer[]))
+                    """, (status, provider_sid, error, reminder_ids, offsets))
+                cursor.execute(
+                    "INSERT INTO sms_delivery_log (reminder_ids, lead_days, phone_number, status, provider_sid, error) VALUES (%s, %s, %s, %s, %s, %s)",
+                    (reminder_ids, offsets, phone_number, status, provider_sid, error)
+                )
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Errore durante la registrazione dell'esito di invio dei promemoria {reminder_ids}: {e}")
+                raise
+            finally:
+                cursor.close()
 
-        reminder_date_obj = None
+    def claim_retry_deliveries(self, limit, lease_seconds):
+        """
+        Prende in carico fino a limit invii falliti con backoff scaduto (o rimasti in 'sending' o in coda oltre
+        il lease, es. worker terminato a metà) e ritorna i relativi promemoria, rimessi in coda ('queued'):
+        come nell'invio principale, ogni messaggio passa a 'sending' solo subito prima dell'invio.
+        Gli invii per promemoria con data già passata, o superati dall'SMS di un anticipo successivo,
+        non vengono più ritentati (stato 'expired'). Ogni promemoria ritornato ha anche lead_days.
+        """
+        with self._get_db_connection("claim_retry_deliveries") as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            try:
+                cursor.execute("""
+                    UPDATE sms_outbox SET status = 'expired', next_attempt_at = NULL, updated_at = NOW()
+                    FROM reminders r
+                    WHERE r.id = sms_outbox.reminder_id AND sms_outbox.status IN ('failed', 'sending', 'queued')
+                      AND sms_outbox.next_attempt_at <= NOW()
+                      AND (r.date < CURRENT_DATE OR EXISTS (
+                          SELECT 1 FROM sms_outbox n
+                          WHERE n.reminder_id = sms_outbox.reminder_id AND n.lead_days < sms_outbox.lead_days
+                      ))
+                """)
+                cursor.execute("""
+                    WITH due AS (
+                        SELECT o.reminder_id, o.lead_days FROM sms_outbox o JOIN reminders r ON r.id = o.reminder_id
+                        WHERE o.status IN ('failed', 'sending', 'queued') AND o.next_attempt_at <= NOW() AND r.sent = FALSE
+                        ORDER BY r.phone_number, o.reminder_id
+                        LIMIT %s
+                        FOR UPDATE OF o SKIP LOCKED
+                    ), claimed AS (
+                        UPDATE sms_outbox o
+                        SET status = 'queued', next_attempt_at = NOW() + %s * INTERVAL '1 second', updated_at = NOW()
+                        FROM due WHERE o.reminder_id = due.reminder_id AND o.lead_days = due.lead_days
+                        RETURNING o.reminder_id, o.lead_days
+                    )
+                    SELECT r.id, r.phone_number, r.message, r.date, r.sent, c.lead_days
+                    FROM reminders r JOIN claimed c ON c.reminder_id = r.id
+                    ORDER BY r.phone_number, r.id
+                """, (limit, lease_seconds))
+                reminders = cursor.fetchall()
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"Errore durante la presa in carico degli invii da ritentare: {e}")
+                raise
+            finally:
+                cursor.close()
+        return reminders
+
+    def forecast_send_volume(self, offsets, start_date, end_date, today):
+        """
+        SMS previsti per giorno di invio tra start_date e end_date, con un'unica query aggregata.
+        Ogni promemoria riceve un SMS per ogni anticipo, il giorno date - anticipo (da today in poi),
+        se quell'invio non è già nell'outbox.
+        Ritorna {giorno di invio: (promemoria, destinatari distinti)}.
+        """
+        offsets = sorted(set(offsets))
+        with self._get_db_connection("forecast_send_volume") as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    SELECT r.date - o.lead_days AS send_date, COUNT(*), COUNT(DISTINCT r.phone_number)
+                    FROM reminders r CROSS JOIN unnest(%(offsets)s::integer[]) AS o(lead_days)
+                    WHERE r.sent = FALSE
+                      AND r.date BETWEEN %(start_date)s::date + %(min_offset)s AND %(end_date)s::date + %(max_offset)s
+                      AND r.date - o.lead_days BETWEEN GREATEST(%(start_date)s, %(today)s) AND %(end_date)s
+                      -- Come in claim_due_reminders: gli invii per quell'anticipo già presenti nell'outbox
+                      -- (consegnati, falliti o scartati) non sono più nel flusso principale
+                      AND NOT EXISTS (
+                          SELECT 1 FROM sms_outbox x
+                          WHERE x.reminder_id = r.id AND x.lead_days = o.lead_days AND x.status <> 'queued'
+                      )
+                    GROUP BY send_date
+                """, {
+                    "offsets": offsets, "today": today, "start_date": start_date, "end_date": end_date,
+                    "min_offset": offsets[0], "max_offset": offsets[-1]
+                })
+                rows = cursor.fetchall()
+            finally:
+                cursor.close()
+                conn.rollback()
+        return {send_date: (reminders, recipients) for send_date, reminders, recipients in rows}
+
+    @contextmanager
+    def run_lock(self, lock_key=REMINDERS_RUN_LOCK_KEY):
+        """
+        Advisory lock di sessione, condiviso tra tutti i worker/host che usano lo stesso DB.
+        Produce True se il lock è stato acquisito, False se un'altra esecuzione è in corso.
+        """
+        with self._get_db_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("SELECT pg_try_advisory_lock(%s)", (lock_key,))
+                acquired = cursor.fetchone()[0]
+                conn.commit()
+                try:
+                    yield acquired
+                finally:
+                    if acquired:
+                        # Il lock è di sessione: va rilasciato prima di restituire la connessione al pool
+                        cursor.execute("SELECT pg_advisory_unlock(%s)", (lock_key,))
+                        conn.commit()
+            finally:
+                cursor.close()
+
+class ReminderLogicAgent:
+    def __init__(self, lead_days=3, offsets=None):
+        # Anticipi (in giorni) con cui viene inviato il promemoria, es. (30, 7, 1): un SMS per ciascuno.
+        # Di default solo lead_days; l'ordine in cui sono indicati non conta
+        self.offsets = tuple(sorted(set(offsets), reverse=True)) if offsets else (lead_days,)
+        # Ultimo anticipo (il più piccolo): dopo questo SMS il promemoria è marcato come inviato
+        self.lead_days = min(self.offsets)
+
+    def due_dates(self, today=None, offsets=None):
+        """Dizionario {data promemoria: anticipo in giorni} per tutti gli anticipi, con "oggi" calcolato una volta."""
+        today = today or datetime.now().date()
+        return {today + timedelta(days=offset): offset for offset in (offsets or self.offsets)}
+
+    @staticmethod
+    def _to_date(reminder_date_param):
+        """Converte datetime/date/stringa YYYY-MM-DD in date; None se il formato non è valido."""
         if isinstance(reminder_date_param, datetime):
-            reminder_date_obj = reminder_date_param.date()
+            return reminder_date_param.date()
         elif isinstance(reminder_date_param, date): # Già un oggetto date
-             reminder_date_obj = reminder_date_param
+            return reminder_date_param
         else: # Se fosse una stringa (improbabile dal DB ma per sicurezza)
             try:
-                reminder_date_obj = datetime.strptime(str(reminder_date_param), '%Y-%m-%d').date()
+                return datetime.strptime(str(reminder_date_param), '%Y-%m-%d').date()
             except ValueError:
                 print(f"Formato data non valido: {reminder_date_param}")
-                return False
+                return None
+
+    def should_send_reminder(self, reminder_date_param): # Rinominato per chiarezza
+        """
+        Verifica se un promemoria deve essere inviato oggi.
+        La logica originale era: oggi + 3 giorni == data promemoria (ora oggi + uno degli anticipi).
+        """
+        today = datetime.now().date()
+
+        reminder_date_obj = self._to_date(reminder_date_param)
+        if reminder_date_obj is None:
+            return False
+
+        return reminder_date_obj in self.due_dates(today)
 
-        return today + timedelta(days=3) == reminder_date_obj
+    def due_offsets(self, reminder_dates, offsets=None, today=None):
+        """
+        Versione batch di should_send_reminder su più anticipi: ritorna, per ogni data in ingresso,
+        l'anticipo a cui il promemoria è in scadenza oppure None (attenzione: l'anticipo 0 è un valore valido).
+        Con offsets=[lead_days] il risultato è non-None esattamente quando should_send_reminder è True.
+        """
+        by_date = self.due_dates(today, offsets)
+        to_date = self._to_date
+        return [by_date.get(to_date(reminder_date)) for reminder_date in reminder_dates]
+
+    def forecast(self, db_agent, start_date, end_date, today=None, coalesce=True):
+        """
+        Simulazione (dry run) degli invii giorno per giorno tra start_date e end_date con gli anticipi configurati,
+        senza inviare nulla. Con coalesce gli SMS stimati sono uno per destinatario al giorno
+        (senza contare eventuali SMS divisi per il limite di segmenti).
+        """
+        today = today or datetime.now().date()
+        start_date = max(start_date, today)
+        counts = db_agent.forecast_send_volume(self.offsets, start_date, end_date, today) if start_date <= end_date else {}
+        days = []
+        current = start_date
+        while current <= end_date:
+            reminders, recipients = counts.get(current, (0, 0))
+            days.append({
+                "date": current.isoformat(),
+                "reminders": reminders,
+                "recipients": recipients,
+                "messages": recipients if coalesce else reminders
+            })
+            current += timedelta(days=1)
+        return days
 
 class NotificationAgent:
-    def __init__(self, account_sid, auth_token, phone_number):
-        # Verifica che le credenziali siano presenti
-        if not all([account_sid, auth_token, phone_number]):
-            raise ValueError("Twilio credentials (account_sid, auth_token, phone_number) cannot be empty.")
-        self.client = Client(account_sid, auth_token)
-        self.phone_number = phone_number
+    """
+    Invia gli SMS tramite un backend (vedi notification_backends): Twilio per default,
+    oppure un sink locale su file o HTTP per staging e prove di carico.
+    """
+    def __init__(self, account_sid=None, auth_token=None, phone_number=None, backend=None):
+        if backend is None:
+            backend = TwilioBackend(account_sid, auth_token, phone_number)
+        self.backend = backend
 
     def send_sms(self, to_phone_number, message_body):
-        try:
-            message = self.client.messages.create(
-                body=message_body,
-                from_=self.phone_number,
-                to=to_phone_number
-            )
-            print(f"SMS inviato a {to_phone_number} (SID: {message.sid}): {message_body}")
-            return True
-        except Exception as e:
-            print(f"Errore durante l'invio dell'SMS a {to_phone_number}: {e}")
-            return False
+        """
+        Ritorna l'identificativo del messaggio (es. SID Twilio). Gli errori del backend non vengono intercettati:
+        OrchestratorAgent li registra nell'outbox insieme al tentativo fallito.
+        """
+        message_id = self.backend.send(to_phone_number, message_body)
+        print(f"SMS inviato a {to_phone_number} (SID: {message_id}): {message_body}")
+        return message_id
+
+    def close(self):
+        self.backend.close()
 
 class OrchestratorAgent:
-    def __init__(self, db_agent, reminder_logic_agent, notification_agent):
+    def __init__(self, db_agent, reminder_logic_agent, notification_agent, mark_sent_batch_size=100,
+                 max_workers=1, rate_limiter=None, claim_batch_size=500, claim_lease_seconds=600,
+                 coalesce=True, max_segments=3, max_delivery_attempts=5, retry_backoff_base=60, retry_backoff_max=3600):
         self.db_agent = db_agent
         self.reminder_logic_agent = reminder_logic_agent
         self.notification_agent = notification_agent
+        # Ogni quanti SMS inviati viene salvato lo stato "sent" sul DB (al massimo un blocco perso in caso di crash)
+        self.mark_sent_batch_size = max(1, mark_sent_batch_size)
+        # max_workers > 1 abilita l'invio concorrente con un pool di thread
+        self.max_workers = max(1, max_workers)
+        # Opzionale: TokenBucket che limita i messaggi al secondo verso il provider SMS
+        self.rate_limiter = rate_limiter
+        # Promemoria presi in carico per blocco e durata del lease. Se un blocco dura più del lease un altro worker
+        # può riprenderne le righe in coda, ma ogni messaggio passa a 'sending' una volta sola
+        self.claim_batch_size = max(1, claim_batch_size)
+        self.claim_lease_seconds = claim_lease_seconds
+        # Più promemoria per lo stesso numero diventano un unico SMS di al massimo max_segments segmenti
+        self.coalesce = coalesce
+        self.max_segments = max(1, max_segments)
+        # Ritentativi degli invii falliti (retry_failed_deliveries): numero massimo e backoff esponenziale in secondi
+        self.max_delivery_attempts = max(1, max_delivery_attempts)
+        self.retry_backoff_base = retry_backoff_base
+        self.retry_backoff_max = retry_backoff_max
 
-    def process_reminders(self):
-        print("Avvio processo di controllo promemoria tramite OrchestratorAgent...")
-        reminders_processed_count = 0
-        reminders_sent_count = 0
+    @staticmethod
+    def _deliveries(reminders):
+        return [(reminder['id'], reminder['lead_days']) for reminder in reminders]
+
+    def _flush_sent(self, pending_ids):
+        """Salva sul DB un blocco di promemoria inviati. Ritorna quanti sono stati marcati."""
+        if not pending_ids:
+            return 0
+        try:
+            with ORCHESTRATOR_STAGE_SECONDS.time(stage="mark_sent"):
+                self.db_agent.mark_reminders_sent(pending_ids)
+            print(f"Promemoria {pending_ids} marcati come inviati.")
+            return len(pending_ids)
+        except Exception as e:
+            # Loggare l'errore ma continuare se possibile con altri promemoria
+            print(f"Fallimento nel marcare i promemoria {pending_ids} come inviati dopo l'invio SMS: {e}")
+            return 0
+        finally:
+            pending_ids.clear()
+
+    def _send_message(self, message):
+        """
+        Invia un SMS (uno o più promemoria per lo stesso numero).
+        Ritorna (promemoria inclusi, numero destinatario, esito, id del messaggio, errore); esito None = saltato.
+        I promemoria già presi da un altro processo sono esclusi (nessun promemoria incluso = nulla da registrare).
+        """
+        target_phone_number, body, reminders = message
+        if not target_phone_number:
+            # Nessun destinatario: i promemoria vengono saltati senza chiamare il backend
+            return reminders, target_phone_number, None, None, "Numero di telefono mancante"
+
+        if self.rate_limiter:
+            with ORCHESTRATOR_STAGE_SECONDS.time(stage="rate_limit_wait"):
+                self.rate_limiter.acquire()
+        # Lo stato 'sending' (con il suo lease) viene registrato solo ora, dopo l'attesa del rate limiter
+        try:
+            with ORCHESTRATOR_STAGE_SECONDS.time(stage="outbox"):
+                started_ids = set(self.db_agent.start_delivery(self._deliveries(reminders), self.claim_lease_seconds))
+        except Exception as e:
+            print(f"Errore nell'avvio dell'invio SMS a {target_phone_number}: {e}")
+            return reminders, target_phone_number, False, None, str(e)
+        if len(started_ids) < len(reminders):
+            reminders = [reminder for reminder in reminders if reminder['id'] in started_ids]
+            if not reminders:
+                return reminders, target_phone_number, None, None, None
+            body = render_message([format_reminder_item(reminder) for reminder in reminders])
 
+        started = time.perf_counter()
+        error = None
         try:
-            unsent_reminders = self.db_agent.get_unsent_reminders()
+            result = self.notification_agent.send_sms(target_phone_number, body)
+            sms_sent = bool(result)
+            if not sms_sent:
+                error = "Invio non riuscito"
         except Exception as e:
-            print(f"Errore nel recuperare i promemoria dal database: {e}")
-            return {"error": "Database error fetching reminders", "processed": 0, "sent": 0}
+            print(f"Errore durante l'invio dell'SMS a {target_phone_number}: {e}")
+            result, sms_sent, error = None, False, str(e)
+        SMS_SEND_SECONDS.observe(time.perf_counter() - started, outcome="sent" if sms_sent else "failed")
+        provider_sid = result if isinstance(result, str) else None
+        return reminders, target_phone_number, sms_sent, provider_sid, error
 
-        if not unsent_reminders:
-            print("Nessun promemoria non inviato trovato.")
-            return {"message": "Nessun promemoria non inviato.", "processed": 0, "sent": 0}
+    def _record_outcome(self, result, pending_ids):
+        """
+        Registra nell'outbox l'esito di un invio e accoda in pending_ids i promemoria inviati con l'ultimo
+        anticipo (gli SMS degli anticipi precedenti restano solo nell'outbox).
+        Ritorna (esito: sent | failed | skipped, promemoria inclusi).
+        """
+        reminders, target_phone_number, sms_sent, provider_sid, error = result
+        reminder_ids = [reminder['id'] for reminder in reminders]
+        if not reminder_ids:
+            return "skipped", reminders
+        if sms_sent is None:
+            outcome = "skipped"
+            print(f"Promemoria {reminder_ids} saltati: numero di telefono mancante.")
+        elif sms_sent:
+            # Tutti i promemoria inclusi nell'SMS combinato risultano inviati
+            outcome = "sent"
+            final_offset = self.reminder_logic_agent.lead_days
+            pending_ids.extend(reminder['id'] for reminder in reminders if reminder['lead_days'] <= final_offset)
+        else:
+            outcome = "failed"
+            print(f"Invio SMS fallito per promemoria {reminder_ids} a {target_phone_number}: verrà ritentato dal ciclo di retry.")
+        # Un SMS partito ma non registrato resta 'sending': per gli anticipi non finali (che non passano da
+        # pending_ids) verrebbe reinviato alla scadenza del lease, quindi l'esito 'sent' viene registrato con più tentativi
+        attempts = RECORD_SENT_ATTEMPTS if outcome == "sent" else 1
+        for attempt in range(1, attempts + 1):
+            try:
+                with ORCHESTRATOR_STAGE_SECONDS.time(stage="record_delivery"):
+                    self.db_agent.record_delivery(
+                        self._deliveries(reminders), target_phone_number, outcome, provider_sid, error,
+                        max_attempts=self.max_delivery_attempts,
+                        backoff_base=self.retry_backoff_base,
+                        backoff_max=self.retry_backoff_max,
+                        # Jitter: evita che gli invii falliti insieme vengano ritentati tutti nello stesso istante
+                        jitter=random.uniform(0.5, 1.0)
+                    )
+                break
+            except Exception as e:
+                print(f"Impossibile registrare nell'outbox l'esito dei promemoria {reminder_ids} "
+                      f"(tentativo {attempt}/{attempts}): {e}")
+                if attempt < attempts:
+                    time.sleep(RECORD_SENT_RETRY_DELAY * attempt)
+                elif outcome == "sent":
+                    print(f"ATTENZIONE: SMS già consegnato per i promemoria {reminder_ids} ma non registrato: "
+                          f"quelli di un anticipo non finale potranno essere reinviati alla scadenza del lease.")
+        return outcome, reminders
 
-        print(f"Trovati {len(unsent_reminders)} promemoria non inviati.")
+    def _dispatch(self, messages):
+        """Genera gli esiti degli invii, in sequenza o in parallelo secondo max_workers."""
+        if self.max_workers == 1:
+            for message in messages:
+                yield self._send_message(message)
+            return
 
-        for reminder in unsent_reminders:
-            reminders_processed_count += 1
-            # reminder['date'] sarà un oggetto datetime.date da psycopg2 DictCursor
-            if self.reminder_logic_agent.should_send_reminder(reminder['date']):
-                # Formatta la data per il messaggio
-                formatted_date = reminder['date'].strftime('%d/%m/%Y') if isinstance(reminder['date'], (datetime, date)) else reminder['date']
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = [executor.submit(self._send_message, message) for message in messages]
+            # Gli esiti vengono consumati nel thread chiamante: l'aggiornamento del DB resta sequenziale
+            for future in as_completed(futures):
+                yield future.result()
+
+    def process_reminders(self, progress_callback=None):
+        """
+        progress_callback, se fornito, viene chiamato dopo ogni promemoria con
+        (processati, SMS inviati, SMS falliti).
+        """
+        print("Avvio processo di controllo promemoria tramite OrchestratorAgent...")
+        with ORCHESTRATOR_STAGE_SECONDS.time(stage="total"):
+            return self._process_reminders(progress_callback)
+
+    def _process_reminders(self, progress_callback):
+        reminders_processed_count = 0
+        reminders_sent_count = 0
+        sms_ok_count = 0
+        sms_failed_count = 0
+        skipped_count = 0
+        messages_count = 0
+
+        # La regola sui giorni di anticipo resta in ReminderLogicAgent; il filtro viene eseguito in SQL.
+        # Con più anticipi ogni promemoria riceve un SMS per anticipo (outbox per promemoria e anticipo);
+        # la colonna sent diventa TRUE solo con l'ultimo.
+        today = datetime.now().date()
+        due_dates = self.reminder_logic_agent.due_dates(today)
+        due_dates_label = ", ".join(d.isoformat() for d in sorted(due_dates))
+        # Identifica questo worker nei lease (host, processo, thread)
+        worker_id = f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
 
-                personal_message = (
-                    f"Ciao! Ti ricordiamo: {reminder['message']} (Data: {formatted_date})."
+        pending_ids = []
+        try:
+            # Più processi/host possono svuotare in parallelo la coda del giorno: ognuno prende blocchi diversi
+            while True:
+                try:
+                    with ORCHESTRATOR_STAGE_SECONDS.time(stage="fetch"):
+                        due_reminders = self.db_agent.claim_due_reminders(
+                            due_dates, worker_id, self.claim_batch_size, self.claim_lease_seconds
+                        )
+                except Exception as e:
+                    print(f"Errore nel recuperare i promemoria dal database: {e}")
+                    if reminders_processed_count == 0:
+                        return {"error": "Database error fetching reminders", "processed": 0, "sent": 0, "failed": 0, "skipped": 0, "marked_sent": 0}
+                    break
+
+                if not due_reminders:
+                    break
+
+                print(f"Presi in carico {len(due_reminders)} promemoria non inviati in scadenza il {due_dates_label}.")
+                offsets = self.reminder_logic_agent.due_offsets(
+                    [reminder['date'] for reminder in due_reminders], today=today
                 )
+                due_reminders = [dict(reminder, lead_days=offset) for reminder, offset in zip(due_reminders, offsets)]
 
-                target_phone_number = str(reminder['phone_number']).strip()
+                # Invii idempotenti: solo i promemoria senza un SMS già consegnato (outbox) per l'anticipo vengono inviati
+                try:
+                    with ORCHESTRATOR_STAGE_SECONDS.time(stage="outbox"):
+                        to_send, already_sent = self.db_agent.begin_deliveries(
+                            self._deliveries(due_reminders), self.claim_lease_seconds
+                        )
+                except Exception as e:
+                    # I promemoria tornano disponibili alla scadenza del lease
+                    print(f"Errore nella registrazione degli invii nell'outbox: {e}")
+                    break
+                if already_sent:
+                    reminders_processed_count += len(already_sent)
+                    skipped_count += len(already_sent)
+                    REMINDERS_TOTAL.inc(len(already_sent), outcome="already_sent")
+                    print(f"Promemoria {already_sent} già inviati in precedenza (outbox): nessun nuovo SMS.")
+                    # Contati solo come saltati: la marcatura 'sent' mancante viene ripetuta senza contarli tra gli inviati
+                    self._flush_sent(list(already_sent))
+                to_send = set(to_send)
+                due_reminders = [reminder for reminder in due_reminders if reminder['id'] in to_send]
 
-                sms_sent = self.notification_agent.send_sms(target_phone_number, personal_message)
+                # Un SMS per numero di telefono (entro il limite di segmenti) invece di uno per promemoria
+                messages = coalesce_reminders(due_reminders, self.max_segments, self.coalesce)
+                messages_count += len(messages)
 
-                if sms_sent:
-                    try:
-                        self.db_agent.mark_reminder_sent(reminder['id'])
-                        reminders_sent_count += 1
-                        print(f"Promemoria {reminder['id']} marcato come inviato.")
-                    except Exception as e:
-                        # Loggare l'errore ma continuare se possibile con altri promemoria
-                        print(f"Fallimento nel marcare il promemoria {reminder['id']} come inviato dopo l'invio SMS: {e}")
-                else:
-                    print(f"Invio SMS fallito per promemoria {reminder['id']} a {target_phone_number}.")
-            # else: # Debug opzionale
-                # print(f"Promemoria {reminder['id']} (Data: {reminder['date']}) non soddisfa i criteri di invio.")
+                for result in self._dispatch(messages):
+                    outcome, reminders = self._record_outcome(result, pending_ids)
+                    reminders_processed_count += len(reminders)
+                    REMINDERS_TOTAL.inc(len(reminders), outcome=outcome)
+                    if outcome == "skipped":
+                        skipped_count += len(reminders)
+                    elif outcome == "sent":
+                        sms_ok_count += len(reminders)
+                        if len(pending_ids) >= self.mark_sent_batch_size:
+                            reminders_sent_count += self._flush_sent(pending_ids)
+                    else:
+                        sms_failed_count += len(reminders)
+                    if progress_callback:
+                        progress_callback(reminders_processed_count, sms_ok_count, sms_failed_count)
+
+                # Salva lo stato del blocco prima di prenderne in carico un altro
+                reminders_sent_count += self._flush_sent(pending_ids)
+        finally:
+            # Salva l'ultimo blocco anche se il ciclo si interrompe con un'eccezione
+            reminders_sent_count += self._flush_sent(pending_ids)
 
+        if reminders_processed_count == 0:
+            print(f"Nessun promemoria non inviato in scadenza il {due_dates_label}.")
+            return {"message": "Nessun promemoria non inviato.", "processed": 0, "sent": 0, "failed": 0, "skipped": 0,
+                    "marked_sent": 0}
 
-        summary = f"Controllo promemoria completato. Promemoria processati: {reminders_processed_count}. SMS inviati: {reminders_sent_count}."
+        summary = (f"Controllo promemoria completato. Promemoria processati: {reminders_processed_count}. "
+                   f"Promemoria inviati: {sms_ok_count} (SMS composti: {messages_count}; "
+                   f"marcati come inviati con l'ultimo anticipo: {reminders_sent_count}).")
         print(summary)
-        return {"message": summary, "processed": reminders_processed_count, "sent": reminders_sent_count}
+        # sent ha lo stesso significato di progress.sent nel job (promemoria consegnati al provider);
+        # marked_sent conta quelli salvati come sent = TRUE, come in retry_failed_deliveries
+        return {
+            "message": summary,
+            "processed": reminders_processed_count,
+            "sent": sms_ok_count,
+            "marked_sent": reminders_sent_count,
+            "failed": sms_failed_count,
+            "skipped": skipped_count,
+            "messages": messages_count
+        }
+
+    def retry_failed_deliveries(self):
+        """
+        Un passaggio del ciclo di retry (vedi jobs.PeriodicTask): reinvia gli SMS falliti il cui backoff è scaduto.
+        Gira separato da process_reminders, così i fallimenti non rallentano l'invio principale.
+        """
+        counts = {"sent": 0, "failed": 0, "skipped": 0}
+        marked_sent = 0
+        pending_ids = []
+        try:
+            while True:
+                with ORCHESTRATOR_STAGE_SECONDS.time(stage="retry_fetch"):
+                    reminders = self.db_agent.claim_retry_deliveries(self.claim_batch_size, self.claim_lease_seconds)
+                if not reminders:
+                    break
+                print(f"Retry: {len(reminders)} promemoria da reinviare.")
+                messages = coalesce_reminders(reminders, self.max_segments, self.coalesce)
+                for result in self._dispatch(messages):
+                    outcome, included = self._record_outcome(result, pending_ids)
+                    counts[outcome] += len(included)
+                    DELIVERY_RETRIES_TOTAL.inc(len(included), outcome=outcome)
+                    REMINDERS_TOTAL.inc(len(included), outcome=outcome)
+                marked_sent += self._flush_sent(pending_ids)
+        finally:
+            marked_sent += self._flush_sent(pending_ids)
+
+        if any(counts.values()):
+            print(f"Retry completato: {counts['sent']} promemoria inviati, {counts['failed']} falliti, {counts['skipped']} saltati.")
+        counts["marked_sent"] = marked_sent
+        return counts
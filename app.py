@@ -1,143 +1,238 @@
-from flask import Flask, request, render_template, redirect, flash, session, url_for, send_file, jsonify # Aggiunto jsonify
+from flask import Flask, Blueprint, current_app, g, request, render_template, redirect, flash, url_for, jsonify, Response
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-import psycopg2.extras # Aggiunto per DictCursor in app.py se necessario
 
-# Importa i nuovi agenti
-from agents import DatabaseAgent, ReminderLogicAgent, NotificationAgent, OrchestratorAgent
+# Agenti e risorse condivise, creati al primo utilizzo (vedi services.AppServices)
+from services import AppServices, load_config
+from csv_ingest import ingest_reminders_csv
+from csv_export import (iter_reminders_csv, iter_reminders_delta_csv, export_version, export_etag,
+                        encode_delta_cursor, parse_delta_since)
+from reminder_queries import parse_reminder_filters, parse_page_args, fetch_reminders_page
+from metrics import REGISTRY, Histogram, CallbackGauge
+from jobs import Job, JOBS_TABLE_SQL, JOBS_ACTIVE_INDEX_SQL
+from reminder_partitions import (REMINDERS_TABLE_SQL, ARCHIVE_TABLE_SQL, is_partitioned, ensure_future_partitions,
+                                 partition_existing_reminders, archive_reminders, active_date_range)
 from werkzeug.security import generate_password_hash, check_password_hash
-import psycopg2
-import csv
+from werkzeug.http import is_resource_modified
 import io
+import time
 from dotenv import load_dotenv
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
+import click
 
 # Carica le variabili dal file .env
 load_dotenv()
 
-# Configurazione Flask
-app = Flask(__name__)
-app.secret_key = os.getenv('FLASK_SECRET_KEY')  # Usa la secret key dal file .env
-
-# Configurazione Flask-Login
+# Configurazione Flask-Login (collegato all'app in create_app)
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = "login"
-
-# Configurazione PostgreSQL
-db_config = {
-    "host": os.getenv('DB_HOST'),
-    "user": os.getenv('DB_USER'),
-    "password": os.getenv('DB_PASSWORD'),
-    "database": os.getenv('DB_NAME'),
-    "port": os.getenv('DB_PORT', 5432)  # Porta di default per PostgreSQL
-}
-print(f"Configurazione DB caricata per: {os.getenv('DB_NAME')}")
-
-
-# Inizializzazione degli Agenti
-# Le configurazioni sono caricate da .env all'inizio di app.py
-
-# Twilio config (già caricate da .env grazie a load_dotenv())
-twilio_account_sid = os.getenv('TWILIO_ACCOUNT_SID')
-twilio_auth_token = os.getenv('TWILIO_AUTH_TOKEN')
-twilio_phone_number = os.getenv('TWILIO_PHONE_NUMBER')
-
-# Istanzia gli agenti una volta, così possono essere usati dall'app
-db_agent = DatabaseAgent(db_config)
-reminder_logic_agent = ReminderLogicAgent()
-
-notification_agent = None
-orchestrator_agent = None
-
-try:
-    if not all([twilio_account_sid, twilio_auth_token, twilio_phone_number]):
-        print("ATTENZIONE: Una o più variabili d'ambiente TWILIO non sono impostate (TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_PHONE_NUMBER). L'invio SMS sarà disabilitato.")
-    else:
-        notification_agent = NotificationAgent(
-            account_sid=twilio_account_sid,
-            auth_token=twilio_auth_token,
-            phone_number=twilio_phone_number
+login_manager.login_view = "main.login"
+
+# Rotte dell'applicazione, registrate sull'app da create_app
+bp = Blueprint('main', __name__, cli_group=None)
+
+# Numero massimo di errori di import CSV mostrati all'utente
+MAX_FLASHED_CSV_ERRORS = 10
+
+# Previsione degli invii: giorni mostrati di default e ampiezza massima dell'intervallo
+DEFAULT_FORECAST_DAYS = 14
+MAX_FORECAST_DAYS = 366
+
+def get_services():
+    return current_app.extensions['promem']
+
+# Metriche HTTP e dello stato dei servizi, esposte da /metrics
+HTTP_REQUEST_SECONDS = Histogram(
+    "promem_http_request_seconds", "Durata delle richieste Flask (escluso lo streaming del corpo della risposta)",
+    ["endpoint", "method", "status"]
+)
+CallbackGauge(
+    "promem_db_pool_connections", "Connessioni del pool per stato",
+    lambda: {state: get_services().db_pool.stats()[state] for state in ("in_use", "idle", "waiting")},
+    labelnames=["state"]
+)
+CallbackGauge(
+    "promem_db_pool_checkouts_total", "Connessioni prese dal pool",
+    lambda: get_services().db_pool.stats()["checkouts"], metric_type="counter"
+)
+CallbackGauge(
+    "promem_db_pool_timeouts_total", "Checkout dal pool andati in timeout",
+    lambda: get_services().db_pool.stats()["timeouts"], metric_type="counter"
+)
+CallbackGauge(
+    "promem_user_cache_lookups_total", "Ricerche nella cache utenti per esito",
+    lambda: {"hit": get_services().user_cache.hits, "miss": get_services().user_cache.misses},
+    labelnames=["result"], metric_type="counter"
+)
+
+def _start_request_timer():
+    g.request_started = time.perf_counter()
+
+def _observe_request(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            endpoint=request.endpoint or "unknown", method=request.method, status=str(response.status_code)
         )
-except ValueError as e: # Cattura il ValueError da NotificationAgent se le credenziali sono vuote dopo il check
-    print(f"ERRORE: Impossibile inizializzare NotificationAgent: {e}")
-    # notification_agent rimane None
+    return response
 
-if notification_agent:
-    orchestrator_agent = OrchestratorAgent(db_agent, reminder_logic_agent, notification_agent)
-else:
-    print("ERRORE CRITICO: OrchestratorAgent non può essere inizializzato perché NotificationAgent non è disponibile.")
-    # L'app funzionerà ma /trigger_reminders darà errore o sarà disabilitato.
-
-# Funzione per connettersi a PostgreSQL (usata da parti di app.py, DatabaseAgent ha la sua)
+# Connessione dal pool condiviso (da usare come: with get_db_connection() as db: ...)
 def get_db_connection():
-    return psycopg2.connect(**db_config)
-
-# Test della connessione al database all'avvio
-try:
-    conn_test = get_db_connection()
-    print("✅ Connessione al database PostgreSQL riuscita!")
-    conn_test.close()
-except Exception as e:
-    print(f"❌ Errore durante la connessione al database PostgreSQL: {e}")
-
+    return get_services().db_pool.connection()
+
+
+# Aggiornamenti idempotenti allo schema di `reminders`, applicati sia da create_tables che da setup_db
+REMINDERS_SCHEMA_UPDATES = [
+    # Indice parziale per la ricerca dei promemoria da inviare (sent = FALSE AND date = ...)
+    ("Indice 'idx_reminders_unsent_date'", """
+        CREATE INDEX IF NOT EXISTS idx_reminders_unsent_date
+        ON reminders (date) WHERE sent = FALSE;
+    """),
+    # Lease per la presa in carico dei promemoria da parte di più worker (vedi DatabaseAgent.claim_due_reminders)
+    ("Colonne 'claimed_by'/'claimed_until'", """
+        ALTER TABLE reminders
+            ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(100),
+            ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMPTZ;
+    """),
+    # Chiave naturale: lo stesso promemoria (numero, data, messaggio) non può essere inserito due volte.
+    # Alla prima applicazione i duplicati esistenti vengono rimossi, tenendo il promemoria con id più basso
+    # (marcato come inviato se lo era uno qualsiasi dei duplicati, per non reinviare l'SMS).
+    ("Vincolo 'reminders_natural_key'", """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'reminders_natural_key') THEN
+                UPDATE reminders r SET sent = TRUE
+                WHERE sent IS NOT TRUE AND EXISTS (
+                    SELECT 1 FROM reminders d
+                    WHERE d.phone_number = r.phone_number AND d.date = r.date AND d.message = r.message AND d.sent
+                );
+                DELETE FROM reminders r USING reminders d
+                WHERE r.phone_number = d.phone_number AND r.date = d.date AND r.message = d.message AND r.id > d.id;
+                ALTER TABLE reminders ADD CONSTRAINT reminders_natural_key UNIQUE (phone_number, date, message);
+            END IF;
+        END $$;
+    """),
+    # Outbox: stato di invio per promemoria e anticipo (idempotenza e ritentativi, vedi OrchestratorAgent.retry_failed_deliveries)
+    ("Tabella 'sms_outbox'", """
+        CREATE TABLE IF NOT EXISTS sms_outbox (
+            reminder_id INTEGER NOT NULL,
+            lead_days INTEGER NOT NULL,
+            status VARCHAR(10) NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            provider_sid VARCHAR(64),
+            last_error TEXT,
+            next_attempt_at TIMESTAMPTZ,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (reminder_id, lead_days)
+        );
+    """),
+    ("Indice 'idx_sms_outbox_pending'", """
+        CREATE INDEX IF NOT EXISTS idx_sms_outbox_pending
+        ON sms_outbox (next_attempt_at) WHERE status IN ('failed', 'sending', 'queued');
+    """),
+    # Registro di tutti i tentativi di invio, con SID del provider ed eventuale errore
+    ("Tabella 'sms_delivery_log'", """
+        CREATE TABLE IF NOT EXISTS sms_delivery_log (
+            id BIGSERIAL PRIMARY KEY,
+            reminder_ids INTEGER[] NOT NULL,
+            lead_days INTEGER[],
+            phone_number VARCHAR(20),
+            status VARCHAR(10) NOT NULL,
+            provider_sid VARCHAR(64),
+            error TEXT,
+            attempted_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+    """),
+    # Tracciamento delle modifiche per l'export incrementale (/download_csv?since=... oppure ?cursor=...).
+    # updated_at viene aggiornato esplicitamente dagli UPDATE che cambiano i dati esportati (es. sent)
+    ("Colonne 'created_at'/'updated_at'", """
+        ALTER TABLE reminders
+            ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+    """),
+    ("Indice 'idx_reminders_updated_at'", """
+        CREATE INDEX IF NOT EXISTS idx_reminders_updated_at ON reminders (updated_at, id);
+    """),
+    # Paginazione keyset di /api/reminders su (date, id), con o senza filtro sul numero di telefono
+    ("Indice 'idx_reminders_date_id'", """
+        CREATE INDEX IF NOT EXISTS idx_reminders_date_id ON reminders (date, id);
+    """),
+    ("Indice 'idx_reminders_phone_date_id'", """
+        CREATE INDEX IF NOT EXISTS idx_reminders_phone_date_id ON reminders (phone_number, date, id);
+    """),
+    # Stato dei job di invio, leggibile da ogni worker (vedi jobs.JobStore)
+    ("Tabella 'reminder_jobs'", JOBS_TABLE_SQL),
+    ("Indice 'idx_reminder_jobs_active'", JOBS_ACTIVE_INDEX_SQL),
+    # Archivio dei mesi passati (vedi flask archive-reminders): stesse colonne di reminders, quindi va creato per ultimo
+    ("Tabella 'reminders_archive'", ARCHIVE_TABLE_SQL),
+    # Un archivio creato prima delle colonne created_at/updated_at deve restare compatibile con le partizioni di reminders
+    ("Colonne 'created_at'/'updated_at' di 'reminders_archive'", """
+        ALTER TABLE reminders_archive
+            ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+    """),
+]
+
+def apply_reminders_schema_updates(cursor):
+    for description, statement in REMINDERS_SCHEMA_UPDATES:
+        cursor.execute(statement)
+        print(f"{description}: creato o già esistente.")
+
+    # Partizioni mensili per i prossimi mesi; le tabelle create dalle versioni precedenti vanno convertite
+    # una volta con `flask partition-reminders`
+    if is_partitioned(cursor):
+        created = ensure_future_partitions(cursor, current_app.config["REMINDERS_PARTITION_MONTHS_AHEAD"])
+        print(f"Partizioni di 'reminders' create: {', '.join(created) if created else 'nessuna (già esistenti)'}.")
+    else:
+        print("ATTENZIONE: la tabella 'reminders' non è partizionata. Eseguire `flask partition-reminders` per convertirla.")
 
 # Funzione per creare le tabelle se non esistono
 def create_tables():
     print("Inizio creazione tabelle...")
-    db = get_db_connection()
-    cursor = db.cursor()
-
-    try:
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(50) NOT NULL UNIQUE,
-                password VARCHAR(255) NOT NULL
-            );
-        """)
-        print("Tabella 'users' creata o già esistente.")
-    except Exception as e:
-        print(f"Errore nella creazione della tabella 'users': {e}")
+    with get_db_connection() as db:
+        cursor = db.cursor()
 
-    try:
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS reminders (
-                id SERIAL PRIMARY KEY,
-                phone_number VARCHAR(15) NOT NULL,
-                message TEXT NOT NULL,
-                date DATE NOT NULL,
-                sent BOOLEAN DEFAULT FALSE
-            );
-        """)
-        print("Tabella 'reminders' creata o già esistente.")
-    except Exception as e:
-        print(f"Errore nella creazione della tabella 'reminders': {e}")
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id SERIAL PRIMARY KEY,
+                    username VARCHAR(50) NOT NULL UNIQUE,
+                    password VARCHAR(255) NOT NULL
+                );
+            """)
+            print("Tabella 'users' creata o già esistente.")
+        except Exception as e:
+            print(f"Errore nella creazione della tabella 'users': {e}")
 
-    db.commit()
-    cursor.close()
-    db.close()
-    print("Tabelle verificate/creazione completata.")
+        try:
+            # Partizionata per mese sulla colonna date (vedi reminder_partitions)
+            cursor.execute(REMINDERS_TABLE_SQL)
+            print("Tabella 'reminders' creata o già esistente.")
+            apply_reminders_schema_updates(cursor)
+        except Exception as e:
+            print(f"Errore nella creazione della tabella 'reminders': {e}")
 
+        db.commit()
+        cursor.close()
     print("Tabelle verificate/creazione completata.")
 
 # Creazione utente di default
 def create_default_user():
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute("SELECT id FROM users WHERE username = %s", ("NicoCR",))
-    user = cursor.fetchone()
-
-    if not user:
-        default_password = generate_password_hash("NicoCR@17")
-        cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)", ("NicoCR", default_password))
-        db.commit()
-        print("Utente predefinito creato: NicoCR / NicoCR@17")
-    else:
-        print("Utente predefinito già esistente.")
-    
-    cursor.close()
-    db.close()
+    with get_db_connection() as db:
+        cursor = db.cursor()
+        cursor.execute("SELECT id FROM users WHERE username = %s", ("NicoCR",))
+        user = cursor.fetchone()
+
+        if not user:
+            default_password = generate_password_hash("NicoCR@17")
+            cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)", ("NicoCR", default_password))
+            db.commit()
+            print("Utente predefinito creato: NicoCR / NicoCR@17")
+        else:
+            print("Utente predefinito già esistente.")
+
+        cursor.close()
 
 # Modello utente per Flask-Login
 class User(UserMixin):
@@ -145,57 +240,66 @@ class User(UserMixin):
         self.id = id_
         self.username = username
 
-# Funzione per caricare l'utente
+# Da chiamare quando un utente cambia (logout, modifica o cancellazione)
+def invalidate_user(user_id):
+    get_services().user_cache.invalidate(str(user_id))
+
+# Funzione per caricare l'utente (con cache: evita una query su ogni richiesta autenticata)
 @login_manager.user_loader
 def load_user(user_id):
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute("SELECT id, username FROM users WHERE id = %s", (user_id,))
-    user = cursor.fetchone()
-    cursor.close()
-    db.close()
+    user_cache = get_services().user_cache
+    cached = user_cache.get(str(user_id))
+    if cached is not None:
+        return User(id_=cached[0], username=cached[1])
+
+    with get_db_connection() as db:
+        cursor = db.cursor()
+        cursor.execute("SELECT id, username FROM users WHERE id = %s", (user_id,))
+        user = cursor.fetchone()
+        cursor.close()
 
     if user:
+        user_cache.set(str(user_id), (user[0], user[1]))
         return User(id_=user[0], username=user[1])
     return None
 
 # Rotte dell'applicazione
 
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
 
-        db = get_db_connection()
-        cursor = db.cursor()
-        cursor.execute("SELECT id, username, password FROM users WHERE username = %s", (username,))
-        user = cursor.fetchone()
-        cursor.close()
-        db.close()
+        with get_db_connection() as db:
+            cursor = db.cursor()
+            cursor.execute("SELECT id, username, password FROM users WHERE username = %s", (username,))
+            user = cursor.fetchone()
+            cursor.close()
 
         if user and check_password_hash(user[2], password):
             user_obj = User(id_=user[0], username=user[1])
             login_user(user_obj)
             flash("Accesso effettuato con successo!", "success")
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         else:
             flash("Credenziali errate. Riprova.", "danger")
     return render_template('login.html')
 
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
+    invalidate_user(current_user.id)
     logout_user()
     flash("Logout effettuato con successo.", "info")
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
 
-@app.route('/')
+@bp.route('/')
 @login_required
 def index():
     return render_template('index.html', username=current_user.username)
 
-@app.route('/upload_csv', methods=['GET', 'POST'])
+@bp.route('/upload_csv', methods=['GET', 'POST'])
 @login_required
 def upload_csv():
     if request.method == 'POST':
@@ -214,45 +318,24 @@ def upload_csv():
 
         try:
             stream = io.TextIOWrapper(file.stream, encoding='utf-8')
-            reader = csv.DictReader(stream)
 
-            required_fields = {'phone_number', 'date'}
-            db = get_db_connection()
-            cursor = db.cursor()
-
-            for row_number, row in enumerate(reader, start=1):
-                if not required_fields.issubset(row.keys()):
-                    flash(f"Errore nel CSV: campi mancanti alla riga {row_number}.", "danger")
-                    return redirect(request.url)
-
-                phone_number = row['phone_number'].strip()
-                reminder_date = row['date'].strip()
-                message = row.get('message', '').strip()
-
-                if not phone_number or not reminder_date:
-                    flash(f"Dati mancanti alla riga {row_number}: phone_number o date.", "danger")
-                    return redirect(request.url)
-
-                try:
-                    datetime.strptime(reminder_date, '%Y-%m-%d')
-                except ValueError:
-                    flash(f"Formato data non valido alla riga {row_number}: {reminder_date}.", "danger")
-                    return redirect(request.url)
-
-                if not message:
-                    message = f"Ciao! CR Collaudi ti ricorda che il giorno {reminder_date} scade il collaudo. Non dimenticarlo!"
-
-                cursor.execute("""
-                    INSERT INTO reminders (phone_number, message, date)
-                    VALUES (%s, %s, %s)
-                """, (phone_number, message, reminder_date))
-
-            db.commit()
-            cursor.close()
-            db.close()
-
-            flash("File CSV caricato e promemoria salvati con successo!", "success")
-            return redirect(url_for('index'))
+            # Import in streaming a blocchi, in un'unica transazione; le righe non valide vengono riportate
+            with get_db_connection() as db:
+                report = ingest_reminders_csv(
+                    db, stream, chunk_size=current_app.config["CSV_INGEST_CHUNK_SIZE"],
+                    date_range=active_date_range(current_app.config["REMINDERS_ARCHIVE_AFTER_DAYS"],
+                                                 current_app.config["REMINDERS_PARTITION_MONTHS_AHEAD"])
+                )
+
+            if report.rejected:
+                flash(f"File CSV caricato: {report.inserted} promemoria salvati, {report.skipped} già presenti, {report.rejected} righe scartate.", "warning")
+                for row_number, description in report.errors[:MAX_FLASHED_CSV_ERRORS]:
+                    flash(description, "danger")
+                if report.rejected > MAX_FLASHED_CSV_ERRORS:
+                    flash(f"... e altri {report.rejected - MAX_FLASHED_CSV_ERRORS} errori.", "danger")
+            else:
+                flash(f"File CSV caricato e promemoria salvati con successo! ({report.inserted} righe, {report.skipped} già presenti)", "success")
+            return redirect(url_for('main.index'))
 
         except Exception as e:
             flash(f"Errore durante il caricamento del file CSV: {e}", "danger")
@@ -260,136 +343,372 @@ def upload_csv():
 
     return render_template('upload_csv.html')
 
-@app.route('/download_csv')
+@bp.route('/download_csv')
 @login_required
 def download_csv():
-    db = get_db_connection()
-    cursor = db.cursor()
-    cursor.execute("SELECT phone_number, message, date FROM reminders")
-    reminders = cursor.fetchall()
-    cursor.close()
-    db.close()
-
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["phone_number", "message", "date"])
-    for reminder in reminders:
-        writer.writerow([reminder[0], reminder[1], reminder[2]])
-    output.seek(0)
-
-    return send_file(
-        io.BytesIO(output.getvalue().encode()),
-        mimetype="text/csv",
-        as_attachment=True,
-        download_name="reminders.csv"
+    # Filtri opzionali: ?phone_number=...&date_from=YYYY-MM-DD&date_to=YYYY-MM-DD&sent=true|false&archived=true|false
+    # Export incrementale: ?since=<timestamp ISO 8601> oppure ?cursor=<X-Next-Cursor dell'export precedente>
+    try:
+        filters = parse_reminder_filters(request.args)
+        since = parse_delta_since(request.args)
+    except ValueError as e:
+        flash(str(e), "danger")
+        return redirect(url_for('main.index'))
+    delta = 'since' in request.args or 'cursor' in request.args
+
+    services = get_services()
+    chunk_size = current_app.config["CSV_EXPORT_CHUNK_SIZE"]
+
+    # Richiesta condizionale (solo If-None-Match): se i dati non sono cambiati risponde 304 senza leggere le righe
+    with services.db_pool.connection() as db:
+        version, until = export_version(db)
+    etag = export_etag(version, request.args.items(multi=True))
+    headers = {"Content-Disposition": f"attachment; filename={'reminders_delta' if delta else 'reminders'}.csv"}
+    if not is_resource_modified(request.environ, etag=etag):
+        # Nessun nuovo cursore: il client riusa il proprio, che non salta righe confermate nel frattempo
+        response = Response(status=304, headers=headers)
+    else:
+        if delta:
+            headers["X-Next-Cursor"] = encode_delta_cursor(until)
+        def generate():
+            # La connessione resta presa dal pool solo per la durata dello streaming
+            with services.db_pool.connection() as db:
+                if delta:
+                    yield from iter_reminders_delta_csv(db, since, until, filters, chunk_size=chunk_size)
+                else:
+                    yield from iter_reminders_csv(db, filters, chunk_size=chunk_size)
+
+        response = Response(generate(), mimetype="text/csv", headers=headers)
+    response.set_etag(etag)
+    return response
+
+# Elenco JSON dei promemoria, paginato: ?limit=50&cursor=<next_cursor della pagina precedente>,
+# con gli stessi filtri di download_csv
+@bp.route('/api/reminders')
+@login_required
+def api_reminders():
+    try:
+        filters = parse_reminder_filters(request.args)
+        limit, after = parse_page_args(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    with get_db_connection() as db:
+        reminders, next_cursor = fetch_reminders_page(db, filters, limit, after)
+
+    next_url = url_for('main.api_reminders', **{**request.args.to_dict(), "cursor": next_cursor}) if next_cursor else None
+    return jsonify({"reminders": reminders, "next_cursor": next_cursor, "next_url": next_url})
+
+def build_forecast(services, start_date, end_date):
+    """Previsione degli SMS per giorno (vedi ReminderLogicAgent.forecast), con totali e durata stimata."""
+    config = services.config
+    days = services.reminder_logic_agent.forecast(
+        services.db_agent, start_date, end_date, coalesce=config["SMS_COALESCE"]
     )
+    rate_limit = config["SMS_RATE_LIMIT"]
+    for day in days:
+        # Tempo minimo di invio imposto da SMS_RATE_LIMIT (None se non c'è limite)
+        day["min_send_seconds"] = round(day["messages"] / rate_limit, 1) if rate_limit > 0 else None
+    return {
+        "offsets": list(services.reminder_logic_agent.offsets),
+        "days": days,
+        "total_reminders": sum(day["reminders"] for day in days),
+        "total_messages": sum(day["messages"] for day in days),
+    }
+
+def parse_forecast_range(date_from, date_to, days=DEFAULT_FORECAST_DAYS):
+    """Intervallo della previsione: da date_from (default oggi) a date_to (default date_from + days - 1)."""
+    filters = parse_reminder_filters({"date_from": date_from, "date_to": date_to})
+    start_date = filters.get("date_from") or datetime.now().date()
+    end_date = filters.get("date_to") or start_date + timedelta(days=days - 1)
+    if end_date < start_date:
+        raise ValueError("date_to deve essere successiva a date_from.")
+    if (end_date - start_date).days >= MAX_FORECAST_DAYS:
+        raise ValueError(f"L'intervallo della previsione non può superare {MAX_FORECAST_DAYS} giorni.")
+    return start_date, end_date
+
+# Previsione (dry run) degli SMS che verranno inviati giorno per giorno: ?date_from=YYYY-MM-DD&date_to=YYYY-MM-DD
+@bp.route('/reminders_forecast')
+@login_required
+def reminders_forecast():
+    try:
+        start_date, end_date = parse_forecast_range(request.args.get('date_from'), request.args.get('date_to'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(build_forecast(get_services(), start_date, end_date))
 
 # Rotte temporanee per configurare il database e creare l'utente predefinito
-@app.route('/setup_db')
+@bp.route('/setup_db')
 def setup_db():
     try:
-        db = get_db_connection()
-        cursor = db.cursor()
+        with get_db_connection() as db:
+            cursor = db.cursor()
 
-        # Creazione tabella `users`
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(50) NOT NULL UNIQUE,
-                password VARCHAR(255) NOT NULL
-            );
-        """)
-        print("Tabella 'users' creata o già esistente.")
-
-        # Creazione tabella `reminders`
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS reminders (
-                id SERIAL PRIMARY KEY,
-                phone_number VARCHAR(15) NOT NULL,
-                message TEXT NOT NULL,
-                date DATE NOT NULL,
-                sent BOOLEAN DEFAULT FALSE
-            );
-        """)
-        print("Tabella 'reminders' creata o già esistente.")
+            # Creazione tabella `users`
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id SERIAL PRIMARY KEY,
+                    username VARCHAR(50) NOT NULL UNIQUE,
+                    password VARCHAR(255) NOT NULL
+                );
+            """)
+            print("Tabella 'users' creata o già esistente.")
+
+            # Creazione tabella `reminders`
+            # Partizionata per mese sulla colonna date (vedi reminder_partitions)
+            cursor.execute(REMINDERS_TABLE_SQL)
+            print("Tabella 'reminders' creata o già esistente.")
+            apply_reminders_schema_updates(cursor)
 
-        db.commit()
-        cursor.close()
-        db.close()
+            db.commit()
+            cursor.close()
 
         return "Tabelle create con successo!"
     except Exception as e:
         return f"Errore nella creazione delle tabelle: {e}"
 
 
-@app.route('/create_default_user')
+@bp.route('/create_default_user')
 def create_default_user_route():
     try:
-        db = get_db_connection()
-        cursor = db.cursor()
-
-        # Verifica se l'utente esiste
-        cursor.execute("SELECT id FROM users WHERE username = %s", ("NicoCR",))
-        user = cursor.fetchone()
+        with get_db_connection() as db:
+            cursor = db.cursor()
 
-        if not user:
-            default_password = generate_password_hash("NicoCR@17")
-            cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)", ("NicoCR", default_password))
-            db.commit()
-            return "Utente predefinito creato con successo!"
-        else:
-            return "Utente predefinito già esistente."
+            # Verifica se l'utente esiste
+            cursor.execute("SELECT id FROM users WHERE username = %s", ("NicoCR",))
+            user = cursor.fetchone()
+
+            if not user:
+                default_password = generate_password_hash("NicoCR@17")
+                cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)", ("NicoCR", default_password))
+                db.commit()
+                message = "Utente predefinito creato con successo!"
+            else:
+                message = "Utente predefinito già esistente."
+            cursor.close()
+        return message
 
     except Exception as e:
         return f"Errore nella creazione dell'utente predefinito: {e}"
-    finally:
-        cursor.close()
-        db.close()
+
+# Statistiche del pool di connessioni (in uso, in attesa, latenza di checkout)
+@bp.route('/pool_stats')
+@login_required
+def pool_stats():
+    return jsonify(get_services().db_pool.stats())
+
+# Statistiche della cache utenti (hit/miss)
+@bp.route('/cache_stats')
+@login_required
+def cache_stats():
+    return jsonify({"users": get_services().user_cache.stats()})
+
+# Metriche in formato Prometheus. Non richiede login (lo scraper non ha una sessione):
+# se METRICS_TOKEN è impostato serve l'header "Authorization: Bearer <token>"
+@bp.route('/metrics')
+def metrics():
+    token = current_app.config["METRICS_TOKEN"]
+    if token and request.headers.get("Authorization") != f"Bearer {token}":
+        return Response("Non autorizzato\n", status=401, mimetype="text/plain")
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+# Tempi di avvio (create_app e warm-up) del worker corrente
+@bp.route('/startup_stats')
+@login_required
+def startup_stats():
+    return jsonify(get_services().startup_timings)
+
+# Esecuzione del processo promemoria in background (un solo job alla volta)
+# Gira in un thread senza contesto Flask: riceve i servizi esplicitamente
+def run_reminders_job(services, job):
+    orchestrator_agent = services.orchestrator_agent
+    if not services.config["REMINDERS_EXCLUSIVE_RUNS"]:
+        # La presa in carico con FOR UPDATE SKIP LOCKED evita invii doppi anche senza lock globale
+        result = orchestrator_agent.process_reminders(progress_callback=job.update_progress)
+        print(f"Risultato da orchestrator_agent.process_reminders(): {result}")
+        return result
+
+    # L'advisory lock impedisce sovrapposizioni anche tra worker gunicorn o host diversi
+    with services.db_agent.run_lock() as acquired:
+        if not acquired:
+            job.status = "skipped"
+            job.error = "Un altro processo promemoria è già in esecuzione su un altro worker."
+            print(job.error)
+            return None
+        result = orchestrator_agent.process_reminders(progress_callback=job.update_progress)
+        print(f"Risultato da orchestrator_agent.process_reminders(): {result}")
+        return result
 
 # Nuova rotta per attivare il processo dei promemoria
-@app.route('/trigger_reminders', methods=['POST']) # Usare POST per azioni che modificano stato o eseguono task
+@bp.route('/trigger_reminders', methods=['POST']) # Usare POST per azioni che modificano stato o eseguono task
 @login_required # Proteggere l'endpoint
 def trigger_reminders_route():
-    if not orchestrator_agent:
-        flash("Il sistema di promemoria non è correttamente configurato (NotificationAgent o OrchestratorAgent mancante). Controllare i log del server.", "danger")
-        return redirect(url_for('index'))
+    wants_json = request.accept_mimetypes.best == 'application/json'
+    services = get_services()
+
+    if not services.orchestrator_agent:
+        message = "Il sistema di promemoria non è correttamente configurato (NotificationAgent o OrchestratorAgent mancante). Controllare i log del server."
+        if wants_json:
+            return jsonify({"error": message}), 503
+        flash(message, "danger")
+        return redirect(url_for('main.index'))
+
+    # Qui potresti aggiungere un controllo ulteriore, es. un token specifico se non vuoi solo @login_required
+    # Oppure verificare se l'utente è un admin
+    print(f"Richiesta di trigger promemoria da utente: {current_user.username} (ID: {current_user.id})")
+
+    # Il processo gira in background: la richiesta ritorna subito con l'id del job
+    job, started = services.job_runner.submit("reminders", lambda job: run_reminders_job(services, job))
+    status_url = url_for('main.reminder_job_status', job_id=job.id)
+
+    if wants_json:
+        return jsonify({"job_id": job.id, "started": started, "status_url": status_url}), 202 if started else 409
+
+    if started:
+        flash(f"Controllo scadenze avviato in background (job {job.id}). Stato: {status_url}", "info")
+    else:
+        flash(f"Un controllo scadenze è già in corso (job {job.id}). Stato: {status_url}", "warning")
+    return redirect(url_for('main.index')) # O a una pagina di admin/status dedicata
+
+# Stato dei job promemoria (conteggi processati/inviati/falliti e tempi)
+@bp.route('/reminder_jobs/latest')
+@login_required
+def latest_reminder_job_status():
+    job = get_services().job_runner.latest_status()
+    if not job:
+        return jsonify({"error": "Nessun job eseguito."}), 404
+    return jsonify(job)
 
+@bp.route('/reminder_jobs/<job_id>')
+@login_required
+def reminder_job_status(job_id):
+    job = get_services().job_runner.status(job_id)
+    if not job:
+        return jsonify({"error": f"Job {job_id} non trovato."}), 404
+    return jsonify(job)
+
+
+# Comando CLI (flask send-reminders): permette di avviare l'invio da cron o da altri host
+@bp.cli.command('send-reminders')
+def send_reminders_command():
+    services = get_services()
+    orchestrator_agent = services.orchestrator_agent
+    if not orchestrator_agent:
+        raise SystemExit("OrchestratorAgent non disponibile: controllare la configurazione Twilio.")
+    # Stesso percorso di /trigger_reminders: con REMINDERS_EXCLUSIVE_RUNS non si sovrappone a un invio già in corso
+    job = Job("reminders")
+    result = run_reminders_job(services, job)
+    if job.status == "skipped":
+        raise SystemExit(job.error)
+    print(result)
+    # Senza server web il ciclo di retry non gira: un passaggio a ogni esecuzione da cron
+    print(orchestrator_agent.retry_failed_deliveries())
+
+# Comando CLI (flask forecast-reminders): previsione degli invii senza inviare nulla
+@bp.cli.command('forecast-reminders')
+@click.option('--date-from', help="Primo giorno YYYY-MM-DD (default: oggi).")
+@click.option('--date-to', help="Ultimo giorno YYYY-MM-DD.")
+@click.option('--days', type=int, default=DEFAULT_FORECAST_DAYS, show_default=True, help="Giorni se --date-to non è indicato.")
+def forecast_reminders_command(date_from, date_to, days):
     try:
-        # Qui potresti aggiungere un controllo ulteriore, es. un token specifico se non vuoi solo @login_required
-        # Oppure verificare se l'utente è un admin
-        print(f"Richiesta di trigger promemoria da utente: {current_user.username} (ID: {current_user.id})")
+        start_date, end_date = parse_forecast_range(date_from, date_to, days)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    forecast = build_forecast(get_services(), start_date, end_date)
+    print(f"Anticipi: {forecast['offsets']}")
+    for day in forecast["days"]:
+        print(f"{day['date']}  promemoria: {day['reminders']:>7}  destinatari: {day['recipients']:>7}  SMS: {day['messages']:>7}")
+    print(f"Totale: {forecast['total_reminders']} promemoria, {forecast['total_messages']} SMS.")
+
+# Comando CLI (flask partition-reminders): converte una tabella reminders creata dalle versioni precedenti
+# in una tabella partizionata per mese. Copia tutte le righe bloccando le scritture: da eseguire a servizio fermo.
+@bp.cli.command('partition-reminders')
+def partition_reminders_command():
+    with get_db_connection() as db:
+        cursor = db.cursor()
+        # Colonne e deduplicazione (vincolo reminders_natural_key) vanno applicati prima della copia
+        apply_reminders_schema_updates(cursor)
+        db.commit()
+        cursor.close()
+        copied = partition_existing_reminders(
+            db, current_app.config["REMINDERS_PARTITION_MONTHS_AHEAD"],
+            [statement for _, statement in REMINDERS_SCHEMA_UPDATES]
+        )
+    if copied is None:
+        print("La tabella 'reminders' è già partizionata.")
+    else:
+        print(f"Tabella 'reminders' partizionata: {copied} promemoria copiati.")
+
+# Comando CLI (flask archive-reminders): sposta in reminders_archive i mesi interamente precedenti a --before
+# (default: oggi meno REMINDERS_ARCHIVE_AFTER_DAYS) e crea le partizioni dei mesi futuri. Pensato per cron.
+@bp.cli.command('archive-reminders')
+@click.option('--before', help="Data limite YYYY-MM-DD: vengono archiviati i mesi interamente precedenti.")
+def archive_reminders_command(before):
+    if before:
+        before = datetime.strptime(before, '%Y-%m-%d').date()
+    else:
+        before = datetime.now().date() - timedelta(days=current_app.config["REMINDERS_ARCHIVE_AFTER_DAYS"])
+    with get_db_connection() as db:
+        cursor = db.cursor()
+        if not is_partitioned(cursor):
+            cursor.close()
+            raise SystemExit("La tabella 'reminders' non è partizionata: eseguire prima `flask partition-reminders`.")
+        created = ensure_future_partitions(cursor, current_app.config["REMINDERS_PARTITION_MONTHS_AHEAD"])
+        db.commit()
+        cursor.close()
+        archived = archive_reminders(db, before)
+    print(f"Partizioni create: {len(created)}. Partizioni archiviate: {len(archived)} "
+          f"({sum(rows for _, rows in archived)} promemoria).")
+
+# Comando CLI (flask retry-deliveries): un passaggio del ciclo di retry dell'outbox, es. da cron
+# quando il ciclo in background è disabilitato (DELIVERY_RETRY_INTERVAL=0)
+@bp.cli.command('retry-deliveries')
+def retry_deliveries_command():
+    orchestrator_agent = get_services().orchestrator_agent
+    if not orchestrator_agent:
+        raise SystemExit("OrchestratorAgent non disponibile: controllare la configurazione Twilio.")
+    print(orchestrator_agent.retry_failed_deliveries())
 
-        # Messaggio immediato (anche se non strettamente "prima" dell'esecuzione completa,
-        # ma prima del redirect, l'utente lo vedrà al caricamento della pagina successiva)
-        # Considera che il processo di reminder è sincrono qui.
-        # Per un vero messaggio "avviato", servirebbe JS/AJAX.
-        # Questo è un compromesso per ora.
-        flash("Richiesta di controllo scadenze ricevuta. Il processo è in corso...", "info")
 
-        result = orchestrator_agent.process_reminders() # Esecuzione effettiva
+def create_app(config=None, warm_up=None):
+    """
+    Crea l'app Flask. Non apre connessioni: DB e Twilio vengono inizializzati al primo utilizzo,
+    oppure subito con warm_up=True (o WARM_UP_ON_START=true).
+    Con gunicorn --preload il warm-up va fatto nel worker, dopo il fork (hook post_fork).
+    """
+    started = time.perf_counter()
 
-        # Sovrascrive o aggiunge un nuovo messaggio flash con il risultato effettivo.
-        # Flask gestisce più messaggi flash mostrandoli in sequenza.
-        # Per evitare confusione, potremmo voler solo un messaggio finale.
-        # Decido di mantenere solo il messaggio finale più dettagliato.
-        # Rimuovo il flash precedente e ne creo uno più completo.
+    # Configurazione Flask
+    app = Flask(__name__)
+    app.secret_key = os.getenv('FLASK_SECRET_KEY')  # Usa la secret key dal file .env
+    app.config.update(load_config())
+    if config:
+        app.config.update(config)
+    print(f"Configurazione DB caricata per: {app.config['DB_CONFIG']['database']}")
 
-        flash(f"Controllo scadenze completato. {result.get('message', 'Elaborazione terminata.')}", "success" if not result.get('error') else "warning")
+    services = AppServices(app.config)
+    app.extensions['promem'] = services
 
-        # Per debug, potresti voler loggare 'result' completamente o ritornarlo come JSON se fosse una chiamata API
-        print(f"Risultato da orchestrator_agent.process_reminders(): {result}")
+    login_manager.init_app(app)
+    app.register_blueprint(bp)
+    app.before_request(_start_request_timer)
+    app.after_request(_observe_request)
+
+    services.startup_timings["create_app_ms"] = round((time.perf_counter() - started) * 1000, 3)
+
+    if warm_up if warm_up is not None else app.config["WARM_UP_ON_START"]:
+        services.warm_up()
+    print(f"Tempi di avvio: {services.startup_timings}")
+    return app
 
-    except Exception as e:
-        print(f"Errore critico durante l'esecuzione di orchestrator_agent.process_reminders(): {e}")
-        flash(f"Errore grave durante l'attivazione dei promemoria: {str(e)}", "danger")
-        # Potresti voler loggare l'eccezione completa qui
-        import traceback
-        traceback.print_exc()
 
-    return redirect(url_for('index')) # O a una pagina di admin/status dedicata
+# Istanza usata da `gunicorn app:app` e dall'avvio diretto
+app = create_app()
 
 
 if __name__ == '__main__':
-    create_tables()
-    create_default_user()
+    with app.app_context():
+        get_services().warm_up()
+        create_tables()
+        create_default_user()
     app.run(debug=True)
@@ -0,0 +1,274 @@
+"""
+Benchmark di import CSV, export CSV e invio promemoria su un PostgreSQL locale,
+con un backend di notifica finto (latenza e percentuale di errori configurabili).
+
+Uso:
+    python benchmark.py --database promem_bench --sizes 10000,100000,1000000 --output bench.json
+
+ATTENZIONE: la tabella reminders del database indicato viene svuotata ad ogni dataset.
+Per sicurezza il database deve essere diverso da DB_NAME, salvo --allow-app-database.
+"""
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+from dotenv import load_dotenv
+
+from agents import DatabaseAgent, NotificationAgent, ReminderLogicAgent, OrchestratorAgent
+from csv_export import iter_reminders_csv
+from csv_ingest import ingest_reminders_csv
+from db_pool import ConnectionPool
+from notification_backends import FakeBackend
+from rate_limiter import TokenBucket
+from reminder_partitions import active_date_range
+from services import load_config
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def current_rss_kb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+    except OSError:
+        # Fuori da Linux: picco dell'intero processo
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class RssSampler:
+    """Campiona l'RSS in un thread durante una fase e ne registra il picco."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_kb = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_kb = max(self.peak_kb, current_rss_kb())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.peak_kb = current_rss_kb()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_kb = max(self.peak_kb, current_rss_kb())
+
+
+class TimedNotificationAgent:
+    """Avvolge un NotificationAgent e registra la latenza di ogni invio."""
+
+    def __init__(self, notification_agent):
+        self.notification_agent = notification_agent
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def send_sms(self, to_phone_number, message_body):
+        started = time.perf_counter()
+        try:
+            return self.notification_agent.send_sms(to_phone_number, message_body)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.latencies.append(elapsed)
+
+
+def stage_result(name, rows, elapsed, latencies, peak_rss_kb, **extra):
+    result = {
+        "stage": name,
+        "rows": rows,
+        "seconds": round(elapsed, 4),
+        "throughput_rows_per_s": round(rows / elapsed, 1) if elapsed > 0 else None,
+        "latency_unit": extra.pop("latency_unit", None),
+        "latency_p50_ms": round(percentile(latencies, 50) * 1000, 3) if latencies else None,
+        "latency_p99_ms": round(percentile(latencies, 99) * 1000, 3) if latencies else None,
+        "peak_rss_kb": peak_rss_kb,
+    }
+    result.update(extra)
+    return result
+
+
+def write_synthetic_csv(path, rows, due_date, due_fraction, seed):
+    """Genera un CSV di promemoria: una frazione in scadenza il due_date, il resto nei 365 giorni successivi."""
+    rng = random.Random(seed)
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(["phone_number", "date", "message"])
+        for i in range(rows):
+            if rng.random() < due_fraction:
+                reminder_date = due_date
+            else:
+                reminder_date = due_date + timedelta(days=rng.randint(1, 365))
+            writer.writerow([f"+39{rng.randint(3000000000, 3999999999)}", reminder_date.isoformat(), f"Collaudo veicolo {i}"])
+
+
+def reset_table(pool):
+    with pool.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("TRUNCATE reminders, sms_outbox, sms_delivery_log RESTART IDENTITY")
+        conn.commit()
+        cursor.close()
+
+
+def bench_ingest(pool, csv_path, chunk_size, date_range=None):
+    latencies = []
+    last = [time.perf_counter()]
+
+    def on_chunk(_rows):
+        now = time.perf_counter()
+        latencies.append(now - last[0])
+        last[0] = now
+
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        last[0] = started
+        with pool.connection() as conn, open(csv_path, encoding='utf-8') as f:
+            report = ingest_reminders_csv(conn, f, chunk_size=chunk_size, on_chunk=on_chunk, date_range=date_range)
+        elapsed = time.perf_counter() - started
+    return stage_result("ingest", report.inserted, elapsed, latencies, rss.peak_kb,
+                        latency_unit="chunk", chunk_size=chunk_size, skipped=report.skipped, rejected=report.rejected)
+
+
+def bench_export(pool, chunk_size):
+    latencies = []
+    total_bytes = 0
+    rows = 0
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        last = started
+        first_byte = None
+        with pool.connection() as conn:
+            for chunk in iter_reminders_csv(conn, chunk_size=chunk_size):
+                now = time.perf_counter()
+                if first_byte is None:
+                    first_byte = now - started
+                latencies.append(now - last)
+                last = now
+                total_bytes += len(chunk.encode('utf-8'))
+                rows += chunk.count('\n')
+        elapsed = time.perf_counter() - started
+    # La prima riga è l'intestazione
+    return stage_result("export", max(rows - 1, 0), elapsed, latencies, rss.peak_kb,
+                        latency_unit="chunk", chunk_size=chunk_size, bytes=total_bytes,
+                        time_to_first_byte_ms=round(first_byte * 1000, 3) if first_byte is not None else None)
+
+
+def bench_dispatch(db_config, pool, args):
+    notification = TimedNotificationAgent(
+        NotificationAgent(backend=FakeBackend(latency=args.latency, failure_rate=args.failure_rate, seed=args.seed))
+    )
+    orchestrator = OrchestratorAgent(
+        DatabaseAgent(db_config, pool=pool), ReminderLogicAgent(), notification,
+        mark_sent_batch_size=args.mark_sent_batch_size,
+        max_workers=args.workers,
+        rate_limiter=TokenBucket(args.rate_limit) if args.rate_limit > 0 else None
+    )
+    with RssSampler() as rss:
+        started = time.perf_counter()
+        result = orchestrator.process_reminders()
+        elapsed = time.perf_counter() - started
+    return stage_result("dispatch", result.get("processed", 0), elapsed, notification.latencies, rss.peak_kb,
+                        latency_unit="message", sent=result.get("sent", 0), failed=result.get("failed", 0),
+                        messages=result.get("messages", 0),
+                        workers=args.workers, backend_latency_ms=args.latency * 1000,
+                        backend_failure_rate=args.failure_rate)
+
+
+def run(args):
+    load_dotenv()
+    config = load_config()
+    db_config = dict(config["DB_CONFIG"])
+    if args.database:
+        db_config["database"] = args.database
+    if db_config["database"] == config["DB_CONFIG"]["database"] and not args.allow_app_database:
+        raise SystemExit("Il benchmark svuota la tabella reminders: indicare un database dedicato con --database "
+                         "(oppure --allow-app-database).")
+
+    # Lo schema è quello creato dall'app (create_tables)
+    from app import create_app, create_tables
+    app = create_app(config={"DB_CONFIG": db_config}, warm_up=False)
+    with app.app_context():
+        create_tables()
+
+    pool = ConnectionPool(db_config, minconn=1, maxconn=max(4, args.workers + 2))
+    due_date = min(ReminderLogicAgent().due_dates())
+    results = {
+        "started_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {k: v for k, v in vars(args).items() if k != "output"},
+        "datasets": [],
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            print(f"Dataset da {size} righe...", file=sys.stderr)
+            csv_path = os.path.join(tmp, f"reminders_{size}.csv")
+            write_synthetic_csv(csv_path, size, due_date, args.due_fraction, args.seed)
+            reset_table(pool)
+
+            stages = [
+                bench_ingest(pool, csv_path, args.ingest_chunk_size,
+                             active_date_range(config["REMINDERS_ARCHIVE_AFTER_DAYS"], config["REMINDERS_PARTITION_MONTHS_AHEAD"])),
+                bench_export(pool, args.export_chunk_size),
+                bench_dispatch(db_config, pool, args),
+            ]
+            for stage in stages:
+                print(json.dumps(stage), file=sys.stderr)
+            results["datasets"].append({"rows": size, "stages": stages})
+            os.remove(csv_path)
+
+    if not args.keep_data:
+        reset_table(pool)
+    pool.closeall()
+    return results
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark di import, export e invio promemoria.")
+    parser.add_argument("--database", help="Database PostgreSQL dedicato al benchmark (default: DB_NAME)")
+    parser.add_argument("--allow-app-database", action="store_true", help="Consente di usare il database dell'app")
+    parser.add_argument("--sizes", type=lambda v: [int(x) for x in v.split(",")], default=[10000, 100000, 1000000])
+    parser.add_argument("--due-fraction", type=float, default=0.01, help="Frazione di promemoria in scadenza oggi")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latenza simulata per SMS, in secondi")
+    parser.add_argument("--failure-rate", type=float, default=0.01, help="Percentuale simulata di invii falliti (0-1)")
+    parser.add_argument("--workers", type=int, default=8, help="Thread di invio (OrchestratorAgent.max_workers)")
+    parser.add_argument("--rate-limit", type=float, default=0, help="Messaggi al secondo (0 = nessun limite)")
+    parser.add_argument("--mark-sent-batch-size", type=int, default=100)
+    parser.add_argument("--ingest-chunk-size", type=int, default=1000)
+    parser.add_argument("--export-chunk-size", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep-data", action="store_true", help="Non svuota la tabella al termine")
+    parser.add_argument("--output", help="File JSON dei risultati (default: stdout)")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = run(args)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
@@ -0,0 +1,138 @@
+import base64
+import binascii
+import csv
+import hashlib
+import io
+from datetime import datetime
+
+from reminder_queries import reminder_filters_sql
+
+EXPORT_COLUMNS = ["phone_number", "message", "date"]
+# L'export incrementale include id e stato, così il sistema a valle può aggiornare le righe già ricevute
+DELTA_EXPORT_COLUMNS = ["id", "phone_number", "message", "date", "sent", "created_at", "updated_at"]
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def iter_reminders_csv(conn, filters=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Esporta i promemoria in CSV a blocchi, leggendo con un cursore lato server (named cursor):
+    in memoria resta al massimo un blocco di righe, e il primo blocco parte subito.
+    """
+    filters = filters or {}
+    where, params = reminder_filters_sql(filters)
+    table = "reminders_archive" if filters.get('archived') else "reminders"
+    yield from _iter_csv(conn, EXPORT_COLUMNS, f"SELECT phone_number, message, date FROM {table} {where}".strip(), params, chunk_size)
+
+
+def iter_reminders_delta_csv(conn, since, until, filters=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Export incrementale: solo i promemoria creati o modificati con since <= updated_at < until
+    (since None = dall'inizio), ordinati per (updated_at, id). until va preso da export_version.
+    """
+    filters = filters or {}
+    where, params = reminder_filters_sql(filters)
+    conditions, bounds = ["updated_at < %s"], [until]
+    if since is not None:
+        conditions.append("updated_at >= %s")
+        bounds.append(since)
+    where = (where + " AND " if where else "WHERE ") + " AND ".join(conditions)
+    params = params + bounds
+    table = "reminders_archive" if filters.get('archived') else "reminders"
+    query = f"SELECT {', '.join(DELTA_EXPORT_COLUMNS)} FROM {table} {where} ORDER BY updated_at, id"
+    yield from _iter_csv(conn, DELTA_EXPORT_COLUMNS, query, params, chunk_size)
+
+
+def _iter_csv(conn, columns, query, params, chunk_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    writer.writerow(columns)
+    yield buffer.getvalue()
+
+    cursor = conn.cursor(name="reminders_export")
+    cursor.itersize = chunk_size
+    try:
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows(rows)
+            yield buffer.getvalue()
+    finally:
+        cursor.close()
+        # Il named cursor vive in una transazione: va chiusa prima di restituire la connessione
+        conn.rollback()
+
+
+def export_version(conn):
+    """
+    Versione corrente dei dati esportabili, senza leggere le righe: (ETag base, limite per il delta).
+    L'ETag dipende solo dai dati: MAX(updated_at) e partizioni (cambiano con l'archiviazione). Le transazioni
+    aperte (anche quelle di altri export) limitano solo il delta: una transazione in corso può ancora scrivere
+    righe con updated_at pari al suo inizio, quindi il delta si ferma prima di quell'istante (presuppone che l'app
+    sia l'unico utente che scrive). Una riga confermata in ritardo con updated_at inferiore al massimo non cambia
+    l'ETag: compare nell'export successivo a una nuova modifica.
+    Non esiste un "Last-Modified" affidabile (modifiche nello stesso secondo, archiviazione, commit tardivi):
+    le richieste condizionali vanno confrontate solo con l'ETag.
+    """
+    cursor = conn.cursor()
+    try:
+        cursor.execute("""
+            SELECT
+                (SELECT MAX(updated_at) FROM reminders),
+                (SELECT MIN(xact_start) FROM pg_stat_activity
+                 WHERE datname = current_database() AND pid <> pg_backend_pid() AND xact_start IS NOT NULL
+                   -- Solo le sessioni client: autovacuum e processi di sistema non scrivono promemoria
+                   AND backend_type = 'client backend'),
+                (SELECT string_agg(c.relname, ',' ORDER BY c.relname)
+                 FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                 WHERE i.inhparent IN (to_regclass('reminders'), to_regclass('reminders_archive'))),
+                NOW()
+        """)
+        last_modified, oldest_transaction, partitions, now = cursor.fetchone()
+    finally:
+        cursor.close()
+        conn.rollback()
+    until = min(oldest_transaction, now) if oldest_transaction else now
+    digest = hashlib.sha1(repr((last_modified, partitions)).encode()).hexdigest()
+    return digest, until
+
+
+def export_etag(version_digest, params):
+    """ETag di una richiesta di export: versione dei dati più i parametri (coppie chiave/valore di filtri e cursore)."""
+    query = "&".join(f"{key}={value}" for key, value in sorted(params))
+    return hashlib.sha1(f"{version_digest}?{query}".encode()).hexdigest()
+
+
+def encode_delta_cursor(until):
+    """Cursore opaco per la richiesta successiva dell'export incrementale (header X-Next-Cursor)."""
+    return base64.urlsafe_b64encode(until.isoformat().encode()).decode().rstrip("=")
+
+
+def decode_delta_cursor(value):
+    try:
+        return datetime.fromisoformat(base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode())
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise ValueError(f"Cursore non valido: {value}.")
+
+
+def parse_delta_since(args):
+    """
+    Inizio dell'export incrementale da cursor (X-Next-Cursor di un export precedente) oppure da since
+    (timestamp ISO 8601, es. 2026-10-17T08:00:00+00:00). Ritorna None se l'export è completo.
+    """
+    cursor = (args.get('cursor') or '').strip()
+    since = (args.get('since') or '').strip()
+    if cursor and since:
+        raise ValueError("Indicare cursor oppure since, non entrambi.")
+    if cursor:
+        return decode_delta_cursor(cursor)
+    if since:
+        try:
+            return datetime.fromisoformat(since)
+        except ValueError:
+            raise ValueError(f"Formato non valido per since: {since} (atteso ISO 8601, es. 2026-10-17T08:00:00+00:00).")
+    return None
@@ -0,0 +1,165 @@
+import csv
+import re
+from datetime import date, timedelta
+from functools import lru_cache
+from itertools import islice
+
+import psycopg2.extras
+
+from reminder_partitions import ARCHIVE_TABLE, is_partitioned, existing_partitions, ensure_partitions, month_start, months_between
+
+REQUIRED_FIELDS = {'phone_number', 'date'}
+PHONE_NUMBER_MAX_LENGTH = 15  # come la colonna reminders.phone_number VARCHAR(15)
+# La chiave naturale UNIQUE (phone_number, date, message) è un indice btree: una riga oltre ~2,7 KB farebbe
+# fallire l'intero import. 500 caratteri (al massimo 2000 byte in UTF-8) bastano per un SMS di 3 segmenti
+MESSAGE_MAX_LENGTH = 500
+DEFAULT_CHUNK_SIZE = 1000
+
+INSERT_SQL = (
+    "INSERT INTO reminders (phone_number, message, date) VALUES %s "
+    "ON CONFLICT (phone_number, date, message) DO NOTHING"
+)
+# Per i blocchi con date di mesi già archiviati: i promemoria presenti in reminders_archive non vengono reinseriti
+INSERT_UNLESS_ARCHIVED_SQL = """
+    INSERT INTO reminders (phone_number, message, date)
+    SELECT v.phone_number, v.message, v.date FROM (VALUES %s) AS v(phone_number, message, date)
+    WHERE NOT EXISTS (
+        SELECT 1 FROM reminders_archive a
+        WHERE a.phone_number = v.phone_number AND a.date = v.date AND a.message = v.message
+    )
+    ON CONFLICT (phone_number, date, message) DO NOTHING
+"""
+MAX_REPORTED_ERRORS = 100  # oltre questo numero gli errori vengono solo contati
+
+_DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def default_message(reminder_date):
+    return f"Ciao! CR Collaudi ti ricorda che il giorno {reminder_date} scade il collaudo. Non dimenticarlo!"
+
+
+@lru_cache(maxsize=4096)
+def parse_date(value):
+    """Valida una data nel formato YYYY-MM-DD. Cache: nei CSV le stesse date si ripetono molto."""
+    if not _DATE_RE.match(value):
+        raise ValueError(value)
+    return date.fromisoformat(value)
+
+
+class IngestReport:
+    def __init__(self, max_errors=MAX_REPORTED_ERRORS):
+        self.inserted = 0
+        self.skipped = 0  # righe valide già presenti (nel file o nel database)
+        self.rejected = 0
+        self.errors = []  # (numero riga, descrizione), limitati a max_errors
+        self.max_errors = max_errors
+
+    def add_error(self, row_number, description):
+        self.rejected += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((row_number, description))
+
+    def as_dict(self):
+        return {"inserted": self.inserted, "skipped": self.skipped, "rejected": self.rejected, "errors": self.errors}
+
+
+def validate_row(row_number, row, date_range=None):
+    """
+    Ritorna (phone_number, message, date) oppure solleva ValueError con la descrizione dell'errore.
+    date_range (primo giorno incluso, primo giorno escluso), se indicato, limita le date accettate.
+    """
+    phone_number = (row.get('phone_number') or '').strip()
+    reminder_date = (row.get('date') or '').strip()
+    message = (row.get('message') or '').strip()
+
+    if not phone_number or not reminder_date:
+        raise ValueError(f"Dati mancanti alla riga {row_number}: phone_number o date.")
+    if len(phone_number) > PHONE_NUMBER_MAX_LENGTH:
+        raise ValueError(f"Numero di telefono troppo lungo alla riga {row_number}: {phone_number}.")
+    try:
+        parsed_date = parse_date(reminder_date)
+    except ValueError:
+        raise ValueError(f"Formato data non valido alla riga {row_number}: {reminder_date}.")
+    if date_range and not date_range[0] <= parsed_date < date_range[1]:
+        raise ValueError(
+            f"Data fuori dall'intervallo consentito alla riga {row_number}: {reminder_date} "
+            f"(dal {date_range[0].isoformat()} al {(date_range[1] - timedelta(days=1)).isoformat()})."
+        )
+
+    if len(message) > MESSAGE_MAX_LENGTH:
+        raise ValueError(f"Messaggio troppo lungo alla riga {row_number}: {len(message)} caratteri (massimo {MESSAGE_MAX_LENGTH}).")
+
+    if not message:
+        message = default_message(reminder_date)
+    return phone_number, message, parsed_date
+
+
+def iter_chunks(reader, report, chunk_size=DEFAULT_CHUNK_SIZE, date_range=None):
+    """Legge il CSV a blocchi di chunk_size righe e produce le righe valide di ogni blocco."""
+    numbered = enumerate(reader, start=1)
+    while True:
+        chunk = list(islice(numbered, chunk_size))
+        if not chunk:
+            return
+        valid_rows = []
+        seen = set()
+        for row_number, row in chunk:
+            try:
+                values = validate_row(row_number, row, date_range)
+            except ValueError as e:
+                report.add_error(row_number, str(e))
+                continue
+            # Duplicati nello stesso blocco scartati in memoria; quelli tra blocchi diversi li scarta ON CONFLICT
+            if values in seen:
+                report.skipped += 1
+                continue
+            seen.add(values)
+            valid_rows.append(values)
+        if valid_rows:
+            yield valid_rows
+
+
+def ingest_reminders_csv(conn, text_stream, chunk_size=DEFAULT_CHUNK_SIZE, on_chunk=None, date_range=None):
+    """
+    Importa i promemoria da un CSV in streaming: validazione e INSERT multi-riga a blocchi,
+    tutto in un'unica transazione. Le righe non valide vengono saltate e riportate nel report.
+    date_range (vedi reminder_partitions.active_date_range) limita le date accettate: con la tabella
+    partizionata le partizioni mancanti dell'intervallo vengono create prima, in una transazione breve.
+    Le righe già presenti (stessi phone_number, date e message, nel file, nel database o nell'archivio) non vengono
+    reinserite e sono contate in report.skipped: caricare due volte lo stesso file non crea duplicati.
+    on_chunk, se fornito, viene chiamato con il numero di righe elaborate dopo ogni blocco.
+    """
+    reader = csv.DictReader(text_stream)
+    report = IngestReport()
+
+    if reader.fieldnames is None or not REQUIRED_FIELDS.issubset(reader.fieldnames):
+        raise ValueError(f"Errore nel CSV: campi obbligatori mancanti nell'intestazione ({', '.join(sorted(REQUIRED_FIELDS))}).")
+
+    cursor = conn.cursor()
+    try:
+        # CREATE TABLE ... PARTITION OF blocca tutta la tabella reminders: le partizioni (di norma già esistenti,
+        # vedi create_tables) vanno create e confermate prima dell'import, non dentro la sua transazione
+        if date_range and is_partitioned(cursor):
+            ensure_partitions(cursor, months_between(*date_range))
+        archived_months = set(existing_partitions(cursor, ARCHIVE_TABLE))
+        conn.commit()
+        for rows in iter_chunks(reader, report, chunk_size, date_range):
+            archived = archived_months and any(month_start(row[2]) in archived_months for row in rows)
+            # Un solo statement per blocco (page_size >= righe): rowcount conta le righe effettivamente inserite
+            psycopg2.extras.execute_values(
+                cursor,
+                INSERT_UNLESS_ARCHIVED_SQL if archived else INSERT_SQL,
+                rows,
+                page_size=len(rows)
+            )
+            report.inserted += cursor.rowcount
+            report.skipped += len(rows) - cursor.rowcount
+            if on_chunk:
+                on_chunk(len(rows))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return report
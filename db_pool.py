@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolTimeoutError(Exception):
+    """Nessuna connessione disponibile entro il timeout di checkout."""
+
+
+class ConnectionPool:
+    """
+    Pool di connessioni PostgreSQL condiviso da app.py e DatabaseAgent.
+    Thread-safe: un worker gunicorn con thread multipli usa lo stesso pool.
+    """
+
+    def __init__(self, db_config, minconn=1, maxconn=10, timeout=30.0, health_check_interval=30.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("Dimensioni del pool non valide (serve 0 <= minconn <= maxconn, maxconn >= 1).")
+        self.db_config = db_config
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        # Le connessioni inattive da più di questo intervallo vengono verificate con SELECT 1 al checkout
+        self.health_check_interval = health_check_interval
+
+        self._cond = threading.Condition()
+        self._idle = []  # lista di (connessione, istante dell'ultimo rilascio)
+        self._in_use = set()
+        self._waiting = 0
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._discarded = 0
+        self._checkout_time_total = 0.0
+        self._checkout_time_max = 0.0
+        self._pid = os.getpid()
+
+    def _check_fork(self):
+        """
+        Dopo un fork (es. gunicorn --preload) le connessioni ereditate appartengono al processo padre:
+        il figlio le dimentica senza chiuderle (close() terminerebbe la sessione del padre) e riparte da zero.
+        """
+        if self._pid == os.getpid():
+            return
+        self._cond = threading.Condition()
+        self._idle = []
+        self._in_use = set()
+        self._waiting = 0
+        self._pid = os.getpid()
+
+    def _connect(self):
+        return psycopg2.connect(**self.db_config)
+
+    def open(self):
+        """Apre in anticipo minconn connessioni (warm-up)."""
+        self._check_fork()
+        with self._cond:
+            missing = self.minconn - len(self._idle) - len(self._in_use)
+        for _ in range(max(missing, 0)):
+            conn = self._connect()
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def _is_healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self.health_check_interval:
+            return True
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self._discarded += 1
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self, timeout=None):
+        self._check_fork()
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        while True:
+            candidate = None
+            reserve_new = False
+            with self._cond:
+                while not self._idle and len(self._in_use) >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeoutError(
+                            f"Nessuna connessione disponibile entro {timeout}s (max {self.maxconn})."
+                        )
+                    self._waiting += 1
+                    try:
+                        self._cond.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+
+                if self._idle:
+                    candidate, idle_since = self._idle.pop()
+                else:
+                    reserve_new = True
+                # Riserva lo slot prima di uscire dal lock, così maxconn non viene mai superato
+                placeholder = object()
+                self._in_use.add(placeholder)
+
+            try:
+                if reserve_new:
+                    conn = self._connect()
+                elif self._is_healthy(candidate, idle_since):
+                    conn = candidate
+                else:
+                    with self._cond:
+                        self._discard(candidate)
+                        self._in_use.discard(placeholder)
+                    continue
+            except Exception:
+                with self._cond:
+                    self._in_use.discard(placeholder)
+                    self._cond.notify()
+                raise
+
+            elapsed = time.monotonic() - started
+            with self._cond:
+                self._in_use.discard(placeholder)
+                self._in_use.add(conn)
+                self._checkouts += 1
+                self._checkout_time_total += elapsed
+                self._checkout_time_max = max(self._checkout_time_max, elapsed)
+            return conn
+
+    def putconn(self, conn, close=False):
+        with self._cond:
+            if conn not in self._in_use:
+                raise ValueError("Connessione non appartenente al pool.")
+
+        if not close and not conn.closed:
+            # Non lasciare transazioni aperte su una connessione riutilizzata
+            try:
+                status = conn.get_transaction_status()
+                if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    close = True
+                elif status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                close = True
+
+        with self._cond:
+            self._in_use.discard(conn)
+            if close or conn.closed or len(self._idle) >= self.maxconn:
+                self._discard(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        """
+        Uso: with pool.connection() as conn: ...
+        Il commit resta esplicito; in caso di eccezione viene fatto rollback.
+        """
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        except Exception:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+            raise
+        finally:
+            self.putconn(conn)
+
+    def closeall(self):
+        with self._cond:
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._idle = []
+
+    def stats(self):
+        with self._cond:
+            checkouts = self._checkouts
+            return {
+                "min_size": self.minconn,
+                "max_size": self.maxconn,
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "checkouts": checkouts,
+                "timeouts": self._timeouts,
+                "discarded": self._discarded,
+                "checkout_avg_ms": round(self._checkout_time_total / checkouts * 1000, 3) if checkouts else 0.0,
+                "checkout_max_ms": round(self._checkout_time_max * 1000, 3),
+            }
@@ -0,0 +1,330 @@
+import json
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from datetime import datetime
+
+import psycopg2.extras
+
+# Un job 'running' senza aggiornamenti da più di questo intervallo è considerato interrotto (worker terminato)
+STALE_JOB_SECONDS = 600
+# Ogni quanto, al massimo, l'avanzamento di un job viene salvato sul DB
+PROGRESS_SAVE_INTERVAL = 1.0
+
+# Stato dei job condiviso tra i worker gunicorn (vedi JobStore)
+JOBS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS reminder_jobs (
+        id VARCHAR(32) PRIMARY KEY,
+        name VARCHAR(50) NOT NULL,
+        status VARCHAR(10) NOT NULL,
+        created_at TIMESTAMPTZ NOT NULL,
+        started_at TIMESTAMPTZ,
+        finished_at TIMESTAMPTZ,
+        duration_seconds DOUBLE PRECISION,
+        progress JSONB,
+        result JSONB,
+        error TEXT,
+        updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+    );
+"""
+# Un solo job in corso per nome, su tutti i worker e gli host
+JOBS_ACTIVE_INDEX_SQL = """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_reminder_jobs_active
+    ON reminder_jobs (name) WHERE status IN ('queued', 'running');
+"""
+
+
+class Job:
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = "queued"  # queued -> running -> completed | failed | skipped
+        self.created_at = datetime.now()
+        self.started_at = None
+        self.finished_at = None
+        self._started_monotonic = None
+        self.duration_seconds = None
+        self.progress = {"processed": 0, "sent": 0, "failed": 0}
+        self.result = None
+        self.error = None
+        self._on_progress = None
+
+    @classmethod
+    def from_dict(cls, data):
+        """Job eseguito da un altro worker, ricostruito dallo stato salvato (vedi JobStore)."""
+        job = cls(data["name"])
+        job.id = data["id"]
+        job.status = data["status"]
+        job.duration_seconds = data["elapsed_seconds"]
+        job.progress = data["progress"] or job.progress
+        job.result = data["result"]
+        job.error = data["error"]
+        return job
+
+    def update_progress(self, processed, sent, failed):
+        # Chiamato dal thread del job ad ogni promemoria: solo assegnazioni, nessun lock necessario
+        self.progress = {"processed": processed, "sent": sent, "failed": failed}
+        if self._on_progress:
+            self._on_progress(self)
+
+    def to_dict(self):
+        elapsed = self.duration_seconds
+        if elapsed is None and self._started_monotonic is not None:
+            elapsed = time.monotonic() - self._started_monotonic
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "elapsed_seconds": round(elapsed, 3) if elapsed is not None else None,
+            "progress": dict(self.progress),
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class JobStore:
+    """
+    Stato dei job nella tabella reminder_jobs, così ogni worker gunicorn può riportare lo stato di un job
+    avviato da un altro e il vincolo "un job alla volta" vale per tutti i worker.
+    Un job in corso aggiorna updated_at a ogni salvataggio: oltre stale_after secondi senza aggiornamenti
+    viene considerato interrotto e non blocca più l'avvio di un nuovo job.
+    """
+
+    def __init__(self, pool, stale_after=STALE_JOB_SECONDS):
+        self.pool = pool
+        self.stale_after = stale_after
+
+    @staticmethod
+    def _json(value):
+        return psycopg2.extras.Json(value, dumps=lambda obj: json.dumps(obj, default=str))
+
+    def try_start(self, job):
+        """Registra job come in coda. Ritorna None se registrato, altrimenti lo stato del job già in corso."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    UPDATE reminder_jobs
+                    SET status = 'failed', error = 'Job interrotto: nessun aggiornamento dal worker.',
+                        finished_at = NOW(), updated_at = NOW()
+                    WHERE name = %s AND status IN ('queued', 'running') AND updated_at < NOW() - %s * INTERVAL '1 second'
+                """, (job.name, self.stale_after))
+                cursor.execute("""
+                    INSERT INTO reminder_jobs (id, name, status, created_at, progress)
+                    VALUES (%s, %s, %s, %s, %s)
+                    ON CONFLICT (name) WHERE status IN ('queued', 'running') DO NOTHING
+                    RETURNING id
+                """, (job.id, job.name, job.status, job.created_at, self._json(job.progress)))
+                inserted = cursor.fetchone() is not None
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+        if inserted:
+            return None
+        return self._fetch("name = %s AND status IN ('queued', 'running')", (job.name,))
+
+    def save(self, job):
+        with self.pool.connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute("""
+                    UPDATE reminder_jobs
+                    SET status = %s, started_at = %s, finished_at = %s, duration_seconds = %s,
+                        progress = %s, result = %s, error = %s, updated_at = NOW()
+                    WHERE id = %s
+                """, (job.status, job.started_at, job.finished_at, job.duration_seconds,
+                      self._json(job.progress), self._json(job.result), job.error, job.id))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    def get(self, job_id):
+        return self._fetch("id = %s", (job_id,))
+
+    def latest(self):
+        return self._fetch("TRUE", ())
+
+    def _fetch(self, condition, params):
+        """Stato (come Job.to_dict) del job più recente che soddisfa condition, oppure None."""
+        with self.pool.connection() as conn:
+            cursor = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+            try:
+                cursor.execute(f"""
+                    SELECT id, name, status, created_at, started_at, finished_at, progress, result, error,
+                           COALESCE(duration_seconds, EXTRACT(EPOCH FROM NOW() - started_at)) AS elapsed_seconds
+                    FROM reminder_jobs WHERE {condition}
+                    ORDER BY created_at DESC LIMIT 1
+                """, params)
+                row = cursor.fetchone()
+            finally:
+                cursor.close()
+                conn.rollback()
+        if row is None:
+            return None
+        data = dict(row)
+        for key in ("created_at", "started_at", "finished_at"):
+            data[key] = data[key].isoformat() if data[key] else None
+        if data["elapsed_seconds"] is not None:
+            data["elapsed_seconds"] = round(float(data["elapsed_seconds"]), 3)
+        return data
+
+
+class JobRunner:
+    """
+    Esegue i job in un thread in background, uno alla volta: se un job è già in corso
+    submit() restituisce quello invece di avviarne un altro. Conserva gli ultimi max_history job.
+    Con uno store (JobStore) lo stato è salvato sul DB: il vincolo e le interrogazioni valgono per tutti i worker.
+    """
+
+    def __init__(self, max_history=50, store=None):
+        self.max_history = max_history
+        self.store = store
+        self._jobs = OrderedDict()
+        self._current = None
+        self._lock = threading.Lock()
+        self._last_saved = {}
+
+    def submit(self, name, func):
+        """
+        Avvia func(job) in background. Ritorna (job, avviato): avviato è False se un job
+        era già in esecuzione, e in quel caso viene restituito il job in corso.
+        """
+        with self._lock:
+            if self._current is not None:
+                return self._current, False
+            job = Job(name)
+            if self.store is not None:
+                try:
+                    running = self.store.try_start(job)
+                except Exception as e:
+                    # Senza DB il job resta visibile solo da questo worker (le esecuzioni restano protette dal run_lock)
+                    print(f"Impossibile registrare il job {job.name} sul DB: {e}")
+                    running = None
+                else:
+                    job._on_progress = self._save_progress
+                if running is not None:
+                    # In esecuzione su un altro worker o host
+                    return Job.from_dict(running), False
+            self._current = job
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.max_history:
+                self._jobs.popitem(last=False)
+
+        thread = threading.Thread(target=self._run, args=(job, func), name=f"job-{name}-{job.id[:8]}", daemon=True)
+        thread.start()
+        return job, True
+
+    def _save(self, job):
+        if self.store is None:
+            return
+        try:
+            self.store.save(job)
+        except Exception as e:
+            # Lo stato sul DB è solo informativo: un errore non interrompe il job
+            print(f"Impossibile salvare lo stato del job {job.name} ({job.id}): {e}")
+
+    def _save_progress(self, job):
+        now = time.monotonic()
+        if now - self._last_saved.get(job.id, 0.0) >= PROGRESS_SAVE_INTERVAL:
+            self._last_saved[job.id] = now
+            self._save(job)
+
+    def _run(self, job, func):
+        job.status = "running"
+        job.started_at = datetime.now()
+        job._started_monotonic = time.monotonic()
+        self._save(job)
+        try:
+            job.result = func(job)
+            if job.status == "running":
+                job.status = "completed"
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            print(f"Errore durante l'esecuzione del job {job.name} ({job.id}): {e}")
+            traceback.print_exc()
+        finally:
+            job.duration_seconds = time.monotonic() - job._started_monotonic
+            job.finished_at = datetime.now()
+            self._save(job)
+            self._last_saved.pop(job.id, None)
+            with self._lock:
+                self._current = None
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def current(self):
+        with self._lock:
+            return self._current
+
+    def latest(self):
+        with self._lock:
+            return next(reversed(self._jobs.values()), None)
+
+    def status(self, job_id):
+        """Stato del job (Job.to_dict), anche se eseguito da un altro worker; None se non esiste."""
+        job = self.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        return self.store.get(job_id) if self.store is not None else None
+
+    def latest_status(self):
+        """Stato dell'ultimo job avviato, su questo worker oppure (con lo store) su qualunque worker."""
+        if self.store is not None:
+            return self.store.latest()
+        job = self.latest()
+        return job.to_dict() if job else None
+
+
+class PeriodicTask:
+    """
+    Esegue func() ogni interval secondi in un thread in background, finché non viene chiamato stop().
+    Un'eccezione in func viene registrata e non interrompe il ciclo.
+    """
+
+    def __init__(self, name, func, interval):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.runs = 0
+        self.last_result = None
+        self.last_error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name=f"task-{self.name}", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.last_result = self.func()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Errore durante l'esecuzione del task periodico {self.name}: {e}")
+                traceback.print_exc()
+            self.runs += 1
@@ -0,0 +1,140 @@
+import json
+import random
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from twilio.http.http_client import TwilioHttpClient
+from twilio.rest import Client
+
+
+class NotificationBackend(ABC):
+    """
+    Interfaccia dei backend usati da NotificationAgent.
+    send() ritorna l'identificativo del messaggio (es. SID Twilio) oppure solleva un'eccezione.
+    """
+    name = "base"
+
+    @abstractmethod
+    def send(self, to_phone_number, message_body):
+        pass
+
+    def close(self):
+        pass
+
+
+def _pooled_session(pool_size, max_retries=0):
+    """Sessione HTTP keep-alive con un pool di connessioni dimensionato sui thread di invio."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=max_retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+class TwilioBackend(NotificationBackend):
+    name = "twilio"
+
+    def __init__(self, account_sid, auth_token, phone_number, pool_size=10, timeout=10.0, max_retries=0):
+        # Verifica che le credenziali siano presenti
+        if not all([account_sid, auth_token, phone_number]):
+            raise ValueError("Twilio credentials (account_sid, auth_token, phone_number) cannot be empty.")
+        # Un solo client HTTP con sessione keep-alive condivisa da tutti i thread di invio:
+        # il pool di default di Twilio (min(32, cpu + 4)) scarterebbe connessioni con molti worker
+        http_client = TwilioHttpClient(pool_connections=True, timeout=timeout)
+        http_client.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=max_retries))
+        self.client = Client(account_sid, auth_token, http_client=http_client)
+        self.phone_number = phone_number
+
+    def send(self, to_phone_number, message_body):
+        message = self.client.messages.create(
+            body=message_body,
+            from_=self.phone_number,
+            to=to_phone_number
+        )
+        return message.sid
+
+    def close(self):
+        self.client.http_client.session.close()
+
+
+class FileSinkBackend(NotificationBackend):
+    """Scrive ogni messaggio come riga JSON su file, senza inviare SMS (staging e prove di carico)."""
+    name = "file"
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a', encoding='utf-8', buffering=1)
+
+    def send(self, to_phone_number, message_body):
+        message_id = f"file-{uuid.uuid4().hex}"
+        line = json.dumps({
+            "id": message_id,
+            "to": to_phone_number,
+            "body": message_body,
+            "created_at": datetime.now().isoformat()
+        }, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+        return message_id
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class HttpSinkBackend(NotificationBackend):
+    """
+    Invia ogni messaggio in POST JSON ({"to", "body"}) a un endpoint locale, riusando le connessioni.
+    Se la risposta JSON contiene "id" (o "sid") viene usato come identificativo del messaggio.
+    """
+    name = "http"
+
+    def __init__(self, url, pool_size=10, timeout=10.0):
+        self.url = url
+        self.timeout = timeout
+        self.session = _pooled_session(pool_size)
+
+    def send(self, to_phone_number, message_body):
+        response = self.session.post(self.url, json={"to": to_phone_number, "body": message_body}, timeout=self.timeout)
+        response.raise_for_status()
+        try:
+            payload = response.json()
+        except ValueError:
+            payload = {}
+        # Il messaggio è già stato accettato: una risposta JSON che non è un oggetto non lo rende fallito
+        if not isinstance(payload, dict):
+            payload = {}
+        return payload.get("id") or payload.get("sid") or f"http-{uuid.uuid4().hex}"
+
+    def close(self):
+        self.session.close()
+
+
+class FakeBackend(NotificationBackend):
+    """
+    Backend locale (nessun SMS reale) per test e prove di carico.
+    Simula la latenza della chiamata HTTP e una percentuale di invii falliti, che sollevano un'eccezione.
+    """
+    name = "fake"
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent_messages = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def send(self, to_phone_number, message_body):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            if self._random.random() < self.failure_rate:
+                raise RuntimeError(f"Invio simulato fallito verso {to_phone_number}")
+            self.sent_messages.append((to_phone_number, message_body))
+        return f"fake-{uuid.uuid4().hex}"
@@ -0,0 +1,44 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Rate limiter a token bucket, thread-safe.
+    rate = token aggiunti al secondo (es. messaggi al secondo consentiti dal mittente Twilio),
+    capacity = burst massimo (di default uguale a rate, minimo 1).
+    """
+
+    def __init__(self, rate, capacity=None):
+        if rate <= 0:
+            raise ValueError("Il rate del token bucket deve essere positivo.")
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def try_acquire(self, tokens=1):
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens=1):
+        """Blocca finché non sono disponibili i token richiesti."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            # Attesa fuori dal lock, così gli altri thread possono ricalcolare
+            time.sleep(wait)
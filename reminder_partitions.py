@@ -0,0 +1,228 @@
+import re
+from datetime import date, datetime, timedelta
+
+# Partizioni mensili della tabella reminders (range sulla colonna date): reminders_p2026_10, ...
+# I mesi ormai passati vengono spostati nella tabella reminders_archive, partizionata allo stesso modo.
+REMINDERS_TABLE = "reminders"
+ARCHIVE_TABLE = "reminders_archive"
+DEFAULT_MONTHS_AHEAD = 12
+# Colonne copiate esplicitamente tra reminders e archivio: non si dipende dall'ordine delle colonne
+REMINDER_COLUMNS = "id, phone_number, message, date, sent, claimed_by, claimed_until, created_at, updated_at"
+
+_PARTITION_RE = re.compile(r'^(?P<table>\w+)_p(?P<year>\d{4})_(?P<month>\d{2})$')
+_CREATE_INDEX_RE = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)\s+ON\s+(?:ONLY\s+)?(\w+)', re.IGNORECASE
+)
+
+REMINDERS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS reminders (
+        id SERIAL,
+        phone_number VARCHAR(15) NOT NULL,
+        message TEXT NOT NULL,
+        date DATE NOT NULL,
+        sent BOOLEAN DEFAULT FALSE,
+        PRIMARY KEY (id, date)
+    ) PARTITION BY RANGE (date);
+"""
+
+# Stesse colonne di reminders (necessario per spostare le partizioni con DETACH/ATTACH), senza vincoli né indici
+ARCHIVE_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS reminders_archive (LIKE reminders) PARTITION BY RANGE (date);
+"""
+
+
+def month_start(value):
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.replace(day=1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(table, month):
+    return f"{table}_p{month.year:04d}_{month.month:02d}"
+
+
+def is_partitioned(cursor, table=REMINDERS_TABLE):
+    cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", (table,))
+    return cursor.fetchone() is not None
+
+
+def existing_partitions(cursor, table=REMINDERS_TABLE):
+    """Mesi (primo giorno) delle partizioni esistenti di table, ricavati dal nome della partizione."""
+    cursor.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    """, (table,))
+    months = {}
+    for (name,) in cursor.fetchall():
+        match = _PARTITION_RE.match(name)
+        if match and match.group('table') == table:
+            months[date(int(match.group('year')), int(match.group('month')), 1)] = name
+    return months
+
+
+def ensure_partitions(cursor, months, table=REMINDERS_TABLE, known=None):
+    """
+    Crea le partizioni mancanti per i mesi indicati. known (insieme di mesi già verificati) evita
+    query ripetute durante un import; viene aggiornato. Ritorna i nomi delle partizioni create.
+    """
+    months = {month_start(m) for m in months}
+    if known is None:
+        known = set(existing_partitions(cursor, table))
+    created = []
+    for month in sorted(months - known):
+        name = partition_name(table, month)
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s)",
+            (month, add_months(month, 1))
+        )
+        known.add(month)
+        created.append(name)
+    return created
+
+
+def active_date_range(archive_after_days, months_ahead=DEFAULT_MONTHS_AHEAD, today=None):
+    """
+    Date accettate per i nuovi promemoria: (primo giorno incluso, primo giorno escluso). Va dal mese non ancora
+    archiviabile (today - archive_after_days, vedi archive_reminders) fino a months_ahead mesi avanti,
+    cioè i mesi le cui partizioni sono mantenute da ensure_future_partitions.
+    """
+    today = today or date.today()
+    return month_start(today - timedelta(days=archive_after_days)), add_months(month_start(today), months_ahead + 1)
+
+
+def months_between(first, end):
+    """Mesi (primo giorno) da first incluso a end escluso."""
+    months = []
+    month = month_start(first)
+    while month < end:
+        months.append(month)
+        month = add_months(month, 1)
+    return months
+
+
+def ensure_future_partitions(cursor, months_ahead=DEFAULT_MONTHS_AHEAD, today=None, table=REMINDERS_TABLE):
+    """Partizioni dal mese corrente fino a months_ahead mesi avanti."""
+    current = month_start(today or date.today())
+    return ensure_partitions(cursor, [add_months(current, i) for i in range(months_ahead + 1)], table)
+
+
+def created_index_names(statements, table=REMINDERS_TABLE):
+    """Nomi degli indici su table creati dalle istruzioni SQL indicate (CREATE INDEX ... ON table)."""
+    return [
+        name for statement in statements
+        for name, target in _CREATE_INDEX_RE.findall(statement) if target == table
+    ]
+
+
+def partition_existing_reminders(conn, months_ahead=DEFAULT_MONTHS_AHEAD, schema_updates=()):
+    """
+    Converte una tabella reminders non partizionata (creata dalle versioni precedenti) in una partizionata
+    per mese, copiando tutte le righe in un'unica transazione. schema_updates sono le istruzioni SQL
+    (indici, colonne, vincoli) da riapplicare alla nuova tabella. Ritorna il numero di righe copiate,
+    oppure None se la tabella è già partizionata.
+    """
+    cursor = conn.cursor()
+    try:
+        if is_partitioned(cursor):
+            conn.rollback()
+            return None
+        # Blocca le scritture per tutta la migrazione
+        cursor.execute("LOCK TABLE reminders IN ACCESS EXCLUSIVE MODE")
+        # Nomi di vincoli e indici sono unici per schema: vanno liberati prima di creare la nuova tabella
+        cursor.execute("ALTER TABLE reminders DROP CONSTRAINT IF EXISTS reminders_natural_key")
+        cursor.execute("ALTER TABLE reminders DROP CONSTRAINT IF EXISTS reminders_pkey")
+        # Anche tutti gli indici di schema_updates: con CREATE INDEX IF NOT EXISTS resterebbero sulla vecchia
+        # tabella e sparirebbero con il DROP TABLE finale
+        for index_name in created_index_names(schema_updates):
+            cursor.execute(f"DROP INDEX IF EXISTS {index_name}")
+        cursor.execute("ALTER TABLE reminders RENAME TO reminders_unpartitioned")
+
+        # La sequenza degli id resta la stessa: i nuovi promemoria continuano la numerazione
+        cursor.execute(REMINDERS_TABLE_SQL.replace("id SERIAL", "id INTEGER NOT NULL DEFAULT nextval('reminders_id_seq')"))
+        cursor.execute("ALTER SEQUENCE reminders_id_seq OWNED BY reminders.id")
+        for statement in schema_updates:
+            cursor.execute(statement)
+        # Gli indici di keyset (date, id) e (phone_number, date, id) devono esistere sulla nuova tabella:
+        # meglio annullare la migrazione che lasciare export e API senza indici
+        cursor.execute(
+            "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s",
+            (REMINDERS_TABLE,)
+        )
+        present = {row[0] for row in cursor.fetchall()}
+        missing = [name for name in created_index_names(schema_updates) if name not in present]
+        if missing:
+            raise RuntimeError(f"Indici mancanti sulla tabella partizionata: {', '.join(missing)}.")
+
+        cursor.execute("SELECT MIN(date), MAX(date) FROM reminders_unpartitioned")
+        first, last = cursor.fetchone()
+        months = set()
+        if first is not None:
+            month = month_start(first)
+            while month <= month_start(last):
+                months.add(month)
+                month = add_months(month, 1)
+        current = month_start(date.today())
+        months.update(add_months(current, i) for i in range(months_ahead + 1))
+        ensure_partitions(cursor, months, known=set())
+
+        cursor.execute(f"INSERT INTO reminders ({REMINDER_COLUMNS}) SELECT {REMINDER_COLUMNS} FROM reminders_unpartitioned")
+        copied = cursor.rowcount
+        cursor.execute("DROP TABLE reminders_unpartitioned")
+        conn.commit()
+        return copied
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+
+def archive_reminders(conn, before):
+    """
+    Sposta in reminders_archive le partizioni mensili interamente precedenti alla data before,
+    una transazione per partizione. La partizione viene staccata da reminders e agganciata
+    all'archivio senza copiare righe; se l'archivio ha già quel mese le righe vengono copiate, saltando
+    quelle già archiviate (stesso promemoria caricato di nuovo dopo l'archiviazione).
+    Ritorna [(partizione, righe)].
+    """
+    cursor = conn.cursor()
+    archived = []
+    try:
+        cursor.execute(ARCHIVE_TABLE_SQL)
+        conn.commit()
+        cutoff = month_start(before)
+        for month, name in sorted(existing_partitions(cursor).items()):
+            if add_months(month, 1) > cutoff:
+                continue
+            cursor.execute(f"SELECT COUNT(*) FROM {name}")
+            rows = cursor.fetchone()[0]
+            cursor.execute(f"ALTER TABLE {REMINDERS_TABLE} DETACH PARTITION {name}")
+            archive_months = existing_partitions(cursor, ARCHIVE_TABLE)
+            if month in archive_months:
+                cursor.execute(
+                    f"INSERT INTO {archive_months[month]} ({REMINDER_COLUMNS}) SELECT {REMINDER_COLUMNS} FROM {name} "
+                    "ON CONFLICT DO NOTHING"
+                )
+                cursor.execute(f"DROP TABLE {name}")
+                target = archive_months[month]
+            else:
+                target = partition_name(ARCHIVE_TABLE, month)
+                cursor.execute(f"ALTER TABLE {name} RENAME TO {target}")
+                cursor.execute(
+                    f"ALTER TABLE {ARCHIVE_TABLE} ATTACH PARTITION {target} FOR VALUES FROM (%s) TO (%s)",
+                    (month, add_months(month, 1))
+                )
+            conn.commit()
+            print(f"Partizione {name} archiviata in {target} ({rows} promemoria).")
+            archived.append((name, rows))
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    return archived
@@ -0,0 +1,127 @@
+import base64
+import binascii
+
+from csv_ingest import parse_date, PHONE_NUMBER_MAX_LENGTH
+
+_SENT_VALUES = {'true': True, '1': True, 'false': False, '0': False}
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def parse_reminder_filters(args):
+    """
+    Legge i filtri opzionali dalla query string (phone_number, date_from, date_to in formato YYYY-MM-DD,
+    sent e archived = true/false). Solleva ValueError con un messaggio leggibile se un valore non è valido.
+    """
+    filters = {}
+    phone_number = (args.get('phone_number') or '').strip()
+    if phone_number:
+        if len(phone_number) > PHONE_NUMBER_MAX_LENGTH:
+            raise ValueError(f"Numero di telefono troppo lungo: {phone_number}.")
+        filters['phone_number'] = phone_number
+    for key in ('date_from', 'date_to'):
+        value = (args.get(key) or '').strip()
+        if value:
+            try:
+                filters[key] = parse_date(value)
+            except ValueError:
+                raise ValueError(f"Formato data non valido per {key}: {value} (atteso YYYY-MM-DD).")
+
+    sent = (args.get('sent') or '').strip().lower()
+    if sent:
+        if sent not in _SENT_VALUES:
+            raise ValueError(f"Valore non valido per sent: {sent} (atteso true/false).")
+        filters['sent'] = _SENT_VALUES[sent]
+
+    # archived=true legge dall'archivio dei mesi passati (reminders_archive) invece che da reminders
+    archived = (args.get('archived') or '').strip().lower()
+    if archived:
+        if archived not in _SENT_VALUES:
+            raise ValueError(f"Valore non valido per archived: {archived} (atteso true/false).")
+        filters['archived'] = _SENT_VALUES[archived]
+    return filters
+
+
+def reminder_filters_sql(filters):
+    """Ritorna (clausola WHERE, parametri) per i filtri prodotti da parse_reminder_filters (archived sceglie la tabella)."""
+    conditions = []
+    params = []
+    if 'phone_number' in filters:
+        conditions.append("phone_number = %s")
+        params.append(filters['phone_number'])
+    if 'date_from' in filters:
+        conditions.append("date >= %s")
+        params.append(filters['date_from'])
+    if 'date_to' in filters:
+        conditions.append("date <= %s")
+        params.append(filters['date_to'])
+    if 'sent' in filters:
+        conditions.append("sent = %s")
+        params.append(filters['sent'])
+    where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+    return where, params
+
+
+def encode_page_cursor(reminder_date, reminder_id):
+    """Cursore opaco per la paginazione keyset: l'ultima coppia (date, id) della pagina."""
+    raw = f"{reminder_date.isoformat()}|{reminder_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_page_cursor(value):
+    """Ritorna (date, id) dal cursore prodotto da encode_page_cursor; ValueError se non valido."""
+    try:
+        raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode()
+        reminder_date, reminder_id = raw.split("|")
+        return parse_date(reminder_date), int(reminder_id)
+    except (ValueError, binascii.Error, UnicodeDecodeError):
+        raise ValueError(f"Cursore non valido: {value}.")
+
+
+def parse_page_args(args):
+    """Legge limit (1-MAX_PAGE_SIZE) e cursor dalla query string. Ritorna (limit, (date, id) oppure None)."""
+    limit = (args.get('limit') or '').strip()
+    try:
+        limit = int(limit) if limit else DEFAULT_PAGE_SIZE
+    except ValueError:
+        raise ValueError(f"Valore non valido per limit: {limit}.")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise ValueError(f"limit deve essere compreso tra 1 e {MAX_PAGE_SIZE}.")
+    cursor = (args.get('cursor') or '').strip()
+    return limit, decode_page_cursor(cursor) if cursor else None
+
+
+def fetch_reminders_page(conn, filters, limit=DEFAULT_PAGE_SIZE, after=None):
+    """
+    Una pagina di promemoria ordinati per (date, id), a partire dalla coppia after (esclusa).
+    Paginazione keyset: il costo non dipende dalla posizione della pagina, a differenza di OFFSET;
+    usa gli indici idx_reminders_date_id e idx_reminders_phone_date_id.
+    Ritorna (righe come dict, cursore della pagina successiva oppure None).
+    """
+    where, params = reminder_filters_sql(filters)
+    if after is not None:
+        where = (where + " AND " if where else "WHERE ") + "(date, id) > (%s, %s)"
+        params = params + list(after)
+    table = "reminders_archive" if filters.get('archived') else "reminders"
+
+    cursor = conn.cursor()
+    try:
+        cursor.execute(
+            f"SELECT id, phone_number, message, date, sent FROM {table} {where} ORDER BY date, id LIMIT %s",
+            params + [limit + 1]
+        )
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+        conn.rollback()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_page_cursor(rows[-1][3], rows[-1][0])
+    reminders = [
+        {"id": r[0], "phone_number": r[1], "message": r[2], "date": r[3].isoformat(), "sent": r[4]}
+        for r in rows
+    ]
+    return reminders, next_cursor
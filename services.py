@@ -0,0 +1,226 @@
+import os
+import threading
+import time
+
+from agents import DatabaseAgent, ReminderLogicAgent, NotificationAgent, OrchestratorAgent
+from cache import TTLCache
+from db_pool import ConnectionPool
+from jobs import JobRunner, JobStore, PeriodicTask
+from notification_backends import TwilioBackend, FileSinkBackend, HttpSinkBackend
+from rate_limiter import TokenBucket
+
+
+def _env_flag(name, default):
+    return os.getenv(name, default).lower() in ('1', 'true', 'yes')
+
+
+def load_config():
+    """Legge la configurazione dalle variabili d'ambiente (già caricate da .env in app.py)."""
+    return {
+        # Configurazione PostgreSQL
+        "DB_CONFIG": {
+            "host": os.getenv('DB_HOST'),
+            "user": os.getenv('DB_USER'),
+            "password": os.getenv('DB_PASSWORD'),
+            "database": os.getenv('DB_NAME'),
+            "port": os.getenv('DB_PORT', 5432)  # Porta di default per PostgreSQL
+        },
+        "DB_POOL_MIN": int(os.getenv('DB_POOL_MIN', 1)),
+        "DB_POOL_MAX": int(os.getenv('DB_POOL_MAX', 10)),
+        "DB_POOL_TIMEOUT": float(os.getenv('DB_POOL_TIMEOUT', 30)),
+        "DB_POOL_HEALTH_CHECK_INTERVAL": float(os.getenv('DB_POOL_HEALTH_CHECK_INTERVAL', 30)),
+        # Twilio
+        "TWILIO_ACCOUNT_SID": os.getenv('TWILIO_ACCOUNT_SID'),
+        "TWILIO_AUTH_TOKEN": os.getenv('TWILIO_AUTH_TOKEN'),
+        "TWILIO_PHONE_NUMBER": os.getenv('TWILIO_PHONE_NUMBER'),
+        # Connessioni keep-alive verso Twilio (0 = una per thread di invio) e timeout per richiesta
+        "TWILIO_HTTP_POOL_SIZE": int(os.getenv('TWILIO_HTTP_POOL_SIZE', 0)),
+        "TWILIO_HTTP_TIMEOUT": float(os.getenv('TWILIO_HTTP_TIMEOUT', 10)),
+        # Backend di notifica: twilio (default), file (righe JSON su NOTIFICATION_SINK_PATH)
+        # oppure http (POST JSON a NOTIFICATION_SINK_URL); file e http non inviano SMS reali
+        "NOTIFICATION_BACKEND": os.getenv('NOTIFICATION_BACKEND', 'twilio').lower(),
+        "NOTIFICATION_SINK_PATH": os.getenv('NOTIFICATION_SINK_PATH', 'sms_sink.jsonl'),
+        "NOTIFICATION_SINK_URL": os.getenv('NOTIFICATION_SINK_URL'),
+        # Invio promemoria
+        # Anticipi in giorni rispetto alla data del promemoria, es. "30,7,1" (default: 3): un SMS per anticipo
+        "REMINDER_OFFSETS": [int(x) for x in os.getenv('REMINDER_OFFSETS', '3').split(',') if x.strip()],
+        "REMINDERS_MARK_SENT_BATCH_SIZE": int(os.getenv('REMINDERS_MARK_SENT_BATCH_SIZE', 100)),
+        "SMS_MAX_WORKERS": int(os.getenv('SMS_MAX_WORKERS', 1)),
+        # Messaggi al secondo consentiti dal mittente Twilio (0 = nessun limite)
+        "SMS_RATE_LIMIT": float(os.getenv('SMS_RATE_LIMIT', 0)),
+        # Un solo SMS per numero di telefono con più promemoria, entro SMS_MAX_SEGMENTS segmenti
+        "SMS_COALESCE": _env_flag('SMS_COALESCE', 'true'),
+        "SMS_MAX_SEGMENTS": int(os.getenv('SMS_MAX_SEGMENTS', 3)),
+        "REMINDERS_CLAIM_BATCH_SIZE": int(os.getenv('REMINDERS_CLAIM_BATCH_SIZE', 500)),
+        "REMINDERS_CLAIM_LEASE_SECONDS": int(os.getenv('REMINDERS_CLAIM_LEASE_SECONDS', 600)),
+        # Con REMINDERS_EXCLUSIVE_RUNS=false più worker possono svuotare in parallelo la coda (presa in carico con lease)
+        "REMINDERS_EXCLUSIVE_RUNS": _env_flag('REMINDERS_EXCLUSIVE_RUNS', 'true'),
+        # Outbox: tentativi massimi per invio e backoff esponenziale (secondi) tra un tentativo e il successivo
+        "DELIVERY_MAX_ATTEMPTS": int(os.getenv('DELIVERY_MAX_ATTEMPTS', 5)),
+        "DELIVERY_RETRY_BASE_SECONDS": float(os.getenv('DELIVERY_RETRY_BASE_SECONDS', 60)),
+        "DELIVERY_RETRY_MAX_SECONDS": float(os.getenv('DELIVERY_RETRY_MAX_SECONDS', 3600)),
+        # Ogni quanti secondi il ciclo di retry cerca invii da ritentare (0 = disabilitato, usare flask retry-deliveries)
+        "DELIVERY_RETRY_INTERVAL": float(os.getenv('DELIVERY_RETRY_INTERVAL', 30)),
+        # Partizioni mensili di reminders create in anticipo e giorni dopo i quali un mese finito viene archiviato
+        "REMINDERS_PARTITION_MONTHS_AHEAD": int(os.getenv('REMINDERS_PARTITION_MONTHS_AHEAD', 12)),
+        "REMINDERS_ARCHIVE_AFTER_DAYS": int(os.getenv('REMINDERS_ARCHIVE_AFTER_DAYS', 30)),
+        # Import/export CSV: righe per blocco
+        "CSV_INGEST_CHUNK_SIZE": int(os.getenv('CSV_INGEST_CHUNK_SIZE', 1000)),
+        "CSV_EXPORT_CHUNK_SIZE": int(os.getenv('CSV_EXPORT_CHUNK_SIZE', 2000)),
+        # Cache utenti di Flask-Login
+        "USER_CACHE_SIZE": int(os.getenv('USER_CACHE_SIZE', 1024)),
+        "USER_CACHE_TTL": float(os.getenv('USER_CACHE_TTL', 300)),
+        # Se impostato, /metrics richiede "Authorization: Bearer <METRICS_TOKEN>"
+        "METRICS_TOKEN": os.getenv('METRICS_TOKEN'),
+        # Apre connessioni e client Twilio già alla creazione dell'app invece che al primo utilizzo
+        "WARM_UP_ON_START": _env_flag('WARM_UP_ON_START', 'false'),
+    }
+
+
+class AppServices:
+    """
+    Agenti e risorse condivise dell'app. Pool DB e client Twilio vengono creati al primo utilizzo
+    (o da warm_up()), così l'import di app.py non fa I/O e gunicorn --preload può fare fork in sicurezza.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self._lock = threading.RLock()
+        self._db_pool = None
+        self._db_agent = None
+        self._notification_agent = None
+        self._notification_checked = False
+        self._orchestrator_agent = None
+
+        offsets = config["REMINDER_OFFSETS"]
+        self.reminder_logic_agent = ReminderLogicAgent(offsets=offsets)
+        self._job_runner = None
+        # Ciclo di retry dell'outbox, avviato al primo utilizzo dell'orchestrator (quindi dopo il fork dei worker gunicorn)
+        self.delivery_retry_task = None
+        self.user_cache = TTLCache(maxsize=config["USER_CACHE_SIZE"], ttl=config["USER_CACHE_TTL"])
+        # Tempi di avvio in millisecondi (create_app, warm-up)
+        self.startup_timings = {}
+
+    @property
+    def db_pool(self):
+        with self._lock:
+            if self._db_pool is None:
+                self._db_pool = ConnectionPool(
+                    self.config["DB_CONFIG"],
+                    minconn=self.config["DB_POOL_MIN"],
+                    maxconn=self.config["DB_POOL_MAX"],
+                    timeout=self.config["DB_POOL_TIMEOUT"],
+                    health_check_interval=self.config["DB_POOL_HEALTH_CHECK_INTERVAL"]
+                )
+            return self._db_pool
+
+    @property
+    def job_runner(self):
+        """JobRunner con lo stato dei job sul DB, condiviso da tutti i worker gunicorn."""
+        with self._lock:
+            if self._job_runner is None:
+                self._job_runner = JobRunner(store=JobStore(self.db_pool))
+            return self._job_runner
+
+    @property
+    def db_agent(self):
+        with self._lock:
+            if self._db_agent is None:
+                self._db_agent = DatabaseAgent(self.config["DB_CONFIG"], pool=self.db_pool)
+            return self._db_agent
+
+    @property
+    def notification_agent(self):
+        """NotificationAgent, oppure None se il backend di notifica (es. credenziali Twilio) non è configurato."""
+        with self._lock:
+            if not self._notification_checked:
+                self._notification_checked = True
+                self._notification_agent = self._create_notification_agent()
+            return self._notification_agent
+
+    def _create_notification_agent(self):
+        backend_name = self.config["NOTIFICATION_BACKEND"]
+        try:
+            backend = self._create_notification_backend(backend_name)
+        except ValueError as e: # Cattura il ValueError dal backend se la configurazione non è valida
+            print(f"ERRORE: Impossibile inizializzare NotificationAgent: {e}")
+            return None
+        if backend is None:
+            return None
+        print(f"Backend di notifica: {backend.name}")
+        return NotificationAgent(backend=backend)
+
+    def _create_notification_backend(self, backend_name):
+        pool_size = self.config["TWILIO_HTTP_POOL_SIZE"] or max(1, self.config["SMS_MAX_WORKERS"])
+        if backend_name == "file":
+            return FileSinkBackend(self.config["NOTIFICATION_SINK_PATH"])
+        if backend_name == "http":
+            if not self.config["NOTIFICATION_SINK_URL"]:
+                raise ValueError("NOTIFICATION_SINK_URL è obbligatoria con NOTIFICATION_BACKEND=http.")
+            return HttpSinkBackend(self.config["NOTIFICATION_SINK_URL"], pool_size=pool_size,
+                                   timeout=self.config["TWILIO_HTTP_TIMEOUT"])
+        if backend_name != "twilio":
+            raise ValueError(f"NOTIFICATION_BACKEND non valido: {backend_name} (valori ammessi: twilio, file, http).")
+
+        account_sid = self.config["TWILIO_ACCOUNT_SID"]
+        auth_token = self.config["TWILIO_AUTH_TOKEN"]
+        phone_number = self.config["TWILIO_PHONE_NUMBER"]
+        if not all([account_sid, auth_token, phone_number]):
+            print("ATTENZIONE: Una o più variabili d'ambiente TWILIO non sono impostate (TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_PHONE_NUMBER). L'invio SMS sarà disabilitato.")
+            return None
+        return TwilioBackend(account_sid, auth_token, phone_number, pool_size=pool_size,
+                             timeout=self.config["TWILIO_HTTP_TIMEOUT"])
+
+    @property
+    def orchestrator_agent(self):
+        """OrchestratorAgent, oppure None se NotificationAgent non è disponibile."""
+        with self._lock:
+            if self._orchestrator_agent is None:
+                notification_agent = self.notification_agent
+                if not notification_agent:
+                    return None
+                rate_limit = self.config["SMS_RATE_LIMIT"]
+                self._orchestrator_agent = OrchestratorAgent(
+                    self.db_agent, self.reminder_logic_agent, notification_agent,
+                    mark_sent_batch_size=self.config["REMINDERS_MARK_SENT_BATCH_SIZE"],
+                    max_workers=self.config["SMS_MAX_WORKERS"],
+                    rate_limiter=TokenBucket(rate_limit) if rate_limit > 0 else None,
+                    claim_batch_size=self.config["REMINDERS_CLAIM_BATCH_SIZE"],
+                    claim_lease_seconds=self.config["REMINDERS_CLAIM_LEASE_SECONDS"],
+                    coalesce=self.config["SMS_COALESCE"],
+                    max_segments=self.config["SMS_MAX_SEGMENTS"],
+                    max_delivery_attempts=self.config["DELIVERY_MAX_ATTEMPTS"],
+                    retry_backoff_base=self.config["DELIVERY_RETRY_BASE_SECONDS"],
+                    retry_backoff_max=self.config["DELIVERY_RETRY_MAX_SECONDS"]
+                )
+            # Il ciclo di retry parte al primo utilizzo (e ripartirebbe in un worker nato da un fork)
+            self._start_delivery_retry_loop(self._orchestrator_agent)
+            return self._orchestrator_agent
+
+    def warm_up(self):
+        """Inizializza subito pool DB e agenti (da chiamare dopo il fork, es. nel post_fork di gunicorn)."""
+        started = time.perf_counter()
+        try:
+            self.db_pool.open()
+            print("✅ Connessione al database PostgreSQL riuscita!")
+        except Exception as e:
+            print(f"❌ Errore durante la connessione al database PostgreSQL: {e}")
+        self.startup_timings["warm_up_db_ms"] = round((time.perf_counter() - started) * 1000, 3)
+
+        started = time.perf_counter()
+        if not self.orchestrator_agent:
+            print("ERRORE CRITICO: OrchestratorAgent non può essere inizializzato perché NotificationAgent non è disponibile.")
+        self.startup_timings["warm_up_agents_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        return self.startup_timings
+
+    def _start_delivery_retry_loop(self, orchestrator_agent):
+        """Avvia il ciclo di retry degli invii falliti (una volta per processo; più worker possono eseguirlo in parallelo)."""
+        interval = self.config["DELIVERY_RETRY_INTERVAL"]
+        if interval <= 0:
+            return None
+        if self.delivery_retry_task is None:
+            self.delivery_retry_task = PeriodicTask("delivery-retry", orchestrator_agent.retry_failed_deliveries, interval)
+        # Dopo un fork il thread del processo padre non esiste più: start() lo ricrea
+        if self.delivery_retry_task.start():
+            print(f"Ciclo di retry degli invii avviato (ogni {interval:g} secondi).")
+        return self.delivery_retry_task
@@ -0,0 +1,81 @@
+import re
+from datetime import datetime, date
+
+# Alfabeto GSM 03.38: caratteri base (1 settetto) ed estensione (2 settetti, preceduti da ESC)
+GSM7_BASIC = set(
+    "@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞÆæßÉ !\"#¤%&'()*+,-./0123456789:;<=>?"
+    "¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà"
+)
+GSM7_EXTENDED = set("^{}\\[~]|€\f")
+
+_PHONE_FORMATTING_RE = re.compile(r"[\s\-./()]")
+
+MESSAGE_PREFIX = "Ciao! Ti ricordiamo: "
+ITEM_SEPARATOR = "; "
+
+
+def normalize_phone_number(phone_number):
+    """Rimuove spazi e separatori e converte il prefisso internazionale 00 in +."""
+    normalized = _PHONE_FORMATTING_RE.sub("", str(phone_number or "").strip())
+    if normalized.startswith("00"):
+        normalized = "+" + normalized[2:]
+    return normalized
+
+
+def normalized_phone_sql(column):
+    """Espressione SQL equivalente a normalize_phone_number, per ordinare o raggruppare in PostgreSQL."""
+    return f"regexp_replace(regexp_replace({column}, '[\\s./()-]', '', 'g'), '^00', '+')"
+
+
+def sms_segments(text):
+    """Numero di segmenti SMS del testo: GSM-7 (160 / 153 per segmento) oppure UCS-2 (70 / 67)."""
+    septets = 0
+    for char in text:
+        if char in GSM7_BASIC:
+            septets += 1
+        elif char in GSM7_EXTENDED:
+            septets += 2
+        else:
+            # Un solo carattere fuori dall'alfabeto GSM forza la codifica UCS-2 (conteggio in unità UTF-16)
+            units = len(text.encode('utf-16-le')) // 2
+            return 1 if units <= 70 else -(-units // 67)
+    return 1 if septets <= 160 else -(-septets // 153)
+
+
+def format_reminder_item(reminder):
+    # reminder['date'] sarà un oggetto datetime.date da psycopg2 DictCursor
+    formatted_date = reminder['date'].strftime('%d/%m/%Y') if isinstance(reminder['date'], (datetime, date)) else reminder['date']
+    return f"{reminder['message']} (Data: {formatted_date})"
+
+
+def render_message(items):
+    return f"{MESSAGE_PREFIX}{ITEM_SEPARATOR.join(items)}."
+
+
+def coalesce_reminders(reminders, max_segments=3, coalesce=True):
+    """
+    Raggruppa i promemoria per numero di telefono normalizzato e compone un SMS per gruppo,
+    entro max_segments segmenti; i gruppi troppo lunghi vengono divisi in più SMS.
+    Ritorna una lista di (numero, testo, promemoria inclusi), nell'ordine di prima apparizione del numero.
+    Con coalesce=False produce un SMS per promemoria, come in passato.
+    """
+    groups = {}
+    for reminder in reminders:
+        phone_number = normalize_phone_number(reminder['phone_number'])
+        key = phone_number if coalesce else (phone_number, len(groups))
+        groups.setdefault(key, (phone_number, []))[1].append(reminder)
+
+    messages = []
+    for phone_number, group in groups.values():
+        items = []
+        included = []
+        for reminder in group:
+            item = format_reminder_item(reminder)
+            if items and sms_segments(render_message(items + [item])) > max_segments:
+                messages.append((phone_number, render_message(items), included))
+                items, included = [], []
+            # Un singolo promemoria oltre il limite viene comunque inviato da solo
+            items.append(item)
+            included.append(reminder)
+        messages.append((phone_number, render_message(items), included))
+    return messages
@@ -0,0 +1,256 @@
+import threading
+import time
+from datetime import datetime, timedelta
+
+import agents
+from agents import NotificationAgent, OrchestratorAgent, ReminderLogicAgent
+from notification_backends import FakeBackend
+from sms_coalescing import normalize_phone_number
+from rate_limiter import TokenBucket
+
+
+class FakeDatabaseAgent:
+    """DatabaseAgent in memoria: presa in carico, outbox per (promemoria, anticipo) e marcatura 'sent'."""
+
+    def __init__(self, reminders):
+        self.reminders = {reminder['id']: dict(reminder, sent=False) for reminder in reminders}
+        self.outbox = {}
+        self.claimed = set()
+        self.mark_sent_batches = []
+        self.deliveries = []
+        self._lock = threading.Lock()
+
+    def claim_due_reminders(self, due_dates, worker_id, limit, lease_seconds):
+        with self._lock:
+            claimed = []
+            for reminder in sorted(self.reminders.values(), key=lambda r: (normalize_phone_number(r['phone_number']), r['id'])):
+                lead_days = due_dates.get(reminder['date'])
+                if reminder['sent'] or lead_days is None or reminder['id'] in self.claimed:
+                    continue
+                # Come in DatabaseAgent: un SMS già consegnato passa solo per l'ultimo anticipo
+                status = self.outbox.get((reminder['id'], lead_days), {}).get('status', 'queued')
+                if status != 'queued' and not (status == 'sent' and lead_days == min(due_dates.values())):
+                    continue
+                claimed.append(dict(reminder))
+                if len(claimed) == limit:
+                    break
+            self.claimed.update(reminder['id'] for reminder in claimed)
+            return claimed
+
+    def begin_deliveries(self, deliveries, lease_seconds):
+        with self._lock:
+            to_send, already_sent = [], []
+            for key in deliveries:
+                status = self.outbox.setdefault(key, {'status': 'queued', 'attempts': 0})['status']
+                if status == 'queued':
+                    to_send.append(key[0])
+                elif status == 'sent':
+                    already_sent.append(key[0])
+            return to_send, already_sent
+
+    def start_delivery(self, deliveries, lease_seconds):
+        with self._lock:
+            started = [key for key in deliveries if self.outbox[key]['status'] == 'queued']
+            for key in started:
+                self.outbox[key]['status'] = 'sending'
+            return [reminder_id for reminder_id, _ in started]
+
+    def record_delivery(self, deliveries, phone_number, status, provider_sid=None, error=None,
+                        max_attempts=5, backoff_base=60, backoff_max=3600, jitter=1.0):
+        with self._lock:
+            for key in deliveries:
+                entry = self.outbox[key]
+                entry['attempts'] += 1
+                if status == 'failed':
+                    entry['status'] = 'dead' if entry['attempts'] >= max_attempts else 'failed'
+                else:
+                    entry['status'] = status
+            self.deliveries.append((list(deliveries), phone_number, status))
+
+    def claim_retry_deliveries(self, limit, lease_seconds):
+        with self._lock:
+            claimed = []
+            for (reminder_id, lead_days), entry in sorted(self.outbox.items()):
+                if entry['status'] == 'failed' and not self.reminders[reminder_id]['sent']:
+                    entry['status'] = 'queued'
+                    claimed.append(dict(self.reminders[reminder_id], lead_days=lead_days))
+                if len(claimed) == limit:
+                    break
+            return claimed
+
+    def mark_reminders_sent(self, reminder_ids):
+        with self._lock:
+            self.mark_sent_batches.append(list(reminder_ids))
+            for reminder_id in reminder_ids:
+                self.reminders[reminder_id]['sent'] = True
+                self.claimed.discard(reminder_id)
+            return len(reminder_ids)
+
+    def statuses(self):
+        return sorted(entry['status'] for entry in self.outbox.values())
+
+
+def make_reminders(count, due_date, missing_phone=()):
+    return [
+        {
+            'id': reminder_id,
+            'phone_number': '' if reminder_id in missing_phone else f"+39333000{reminder_id:04d}",
+            'message': f"Appuntamento {reminder_id}",
+            'date': due_date,
+        }
+        for reminder_id in range(1, count + 1)
+    ]
+
+
+def make_orchestrator(db_agent, notification_agent, **kwargs):
+    kwargs.setdefault('max_workers', 4)
+    kwargs.setdefault('rate_limiter', TokenBucket(1000))
+    return OrchestratorAgent(db_agent, ReminderLogicAgent(lead_days=3), notification_agent, **kwargs)
+
+
+def due_date():
+    return datetime.now().date() + timedelta(days=3)
+
+
+def test_concurrent_send_flushes_sent_in_batches():
+    db_agent = FakeDatabaseAgent(make_reminders(40, due_date()))
+    backend = FakeBackend(latency=0.001)
+    notification_agent = NotificationAgent(backend=backend)
+    orchestrator = make_orchestrator(db_agent, notification_agent, mark_sent_batch_size=8, coalesce=False)
+
+    result = orchestrator.process_reminders()
+
+    assert result['processed'] == 40
+    assert result['sent'] == result['marked_sent'] == 40
+    assert result['failed'] == 0
+    assert result['skipped'] == 0
+    assert len(backend.sent_messages) == 40
+    assert [len(batch) for batch in db_agent.mark_sent_batches] == [8, 8, 8, 8, 8]
+    assert all(reminder['sent'] for reminder in db_agent.reminders.values())
+    assert db_agent.statuses() == ['sent'] * 40
+
+
+def test_concurrent_send_counts_failed_and_skipped():
+    missing_phone = {3, 11, 19}
+    db_agent = FakeDatabaseAgent(make_reminders(30, due_date(), missing_phone))
+    backend = FakeBackend(failure_rate=0.3, seed=7)
+    notification_agent = NotificationAgent(backend=backend)
+    orchestrator = make_orchestrator(db_agent, notification_agent, mark_sent_batch_size=5, coalesce=False,
+                                     claim_batch_size=10)
+
+    result = orchestrator.process_reminders()
+
+    sent_ids = {reminder_id for reminder_id, reminder in db_agent.reminders.items() if reminder['sent']}
+    failed_ids = {reminder_id for (reminder_id, _), entry in db_agent.outbox.items() if entry['status'] == 'failed'}
+    skipped_ids = {reminder_id for (reminder_id, _), entry in db_agent.outbox.items() if entry['status'] == 'skipped'}
+    assert result['processed'] == 30
+    assert result['skipped'] == len(missing_phone)
+    assert skipped_ids == missing_phone
+    assert result['failed'] == len(failed_ids) > 0
+    assert result['sent'] == len(sent_ids) == len(backend.sent_messages)
+    assert result['sent'] + result['failed'] + result['skipped'] == 30
+    assert all(len(batch) <= 5 for batch in db_agent.mark_sent_batches)
+    assert sorted(sum(db_agent.mark_sent_batches, [])) == sorted(sent_ids)
+
+    # I falliti passano al ciclo di retry e vengono marcati come inviati
+    backend.failure_rate = 0.0
+    retried = orchestrator.retry_failed_deliveries()
+
+    assert retried['sent'] == retried['marked_sent'] == len(failed_ids)
+    assert all(db_agent.reminders[reminder_id]['sent'] for reminder_id in failed_ids)
+
+
+def test_already_sent_reminders_are_only_counted_as_skipped():
+    db_agent = FakeDatabaseAgent(make_reminders(5, due_date()))
+    # SMS consegnati in un'esecuzione precedente, marcatura 'sent' non riuscita
+    for reminder_id in (2, 4):
+        db_agent.outbox[(reminder_id, 3)] = {'status': 'sent', 'attempts': 1}
+    backend = FakeBackend()
+    notification_agent = NotificationAgent(backend=backend)
+    orchestrator = make_orchestrator(db_agent, notification_agent, coalesce=False)
+
+    result = orchestrator.process_reminders()
+
+    assert (result['processed'], result['sent'], result['skipped'], result['failed']) == (5, 3, 2, 0)
+    assert result['marked_sent'] == 3
+    assert len(backend.sent_messages) == 3
+    assert all(reminder['sent'] for reminder in db_agent.reminders.values())
+
+
+class FlakyRecordDatabaseAgent(FakeDatabaseAgent):
+    """La prima registrazione di un esito fallisce, come per una connessione persa."""
+
+    def __init__(self, reminders):
+        super().__init__(reminders)
+        self.record_failures = 1
+
+    def record_delivery(self, *args, **kwargs):
+        if self.record_failures:
+            self.record_failures -= 1
+            raise RuntimeError("connessione persa")
+        return super().record_delivery(*args, **kwargs)
+
+
+def test_sent_outcome_of_non_final_offset_is_recorded_after_db_error(monkeypatch):
+    monkeypatch.setattr(agents, 'RECORD_SENT_RETRY_DELAY', 0)
+    db_agent = FlakyRecordDatabaseAgent(make_reminders(1, datetime.now().date() + timedelta(days=7)))
+    backend = FakeBackend()
+    notification_agent = NotificationAgent(backend=backend)
+    orchestrator = OrchestratorAgent(db_agent, ReminderLogicAgent(offsets=[7, 3]), notification_agent,
+                                     rate_limiter=TokenBucket(1000), coalesce=False)
+
+    result = orchestrator.process_reminders()
+
+    assert result['sent'] == 1
+    assert result['marked_sent'] == 0
+    # Non resta 'sending': non verrà reinviato alla scadenza del lease
+    assert db_agent.outbox == {(1, 7): {'status': 'sent', 'attempts': 1}}
+
+
+def test_coalesced_failures_count_every_included_reminder():
+    reminders = make_reminders(12, due_date())
+    for reminder in reminders:
+        reminder['phone_number'] = f"+3933300000{reminder['id'] % 3}"
+    db_agent = FakeDatabaseAgent(reminders)
+    backend = FakeBackend(failure_rate=1.0)
+    notification_agent = NotificationAgent(backend=backend)
+    orchestrator = make_orchestrator(db_agent, notification_agent)
+
+    result = orchestrator.process_reminders()
+
+    assert result['messages'] == 3
+    assert result['failed'] == 12
+    assert result['sent'] == 0
+    assert db_agent.mark_sent_batches == []
+    assert db_agent.statuses() == ['failed'] * 12
+
+
+def test_same_customer_in_different_formats_is_claimed_together():
+    reminders = make_reminders(3, due_date())
+    reminders[0]['phone_number'] = "0039 333 000 0001"
+    reminders[1]['phone_number'] = "+393330000002"
+    reminders[2]['phone_number'] = "+393330000001"
+    db_agent = FakeDatabaseAgent(reminders)
+    backend = FakeBackend()
+    orchestrator = make_orchestrator(db_agent, NotificationAgent(backend=backend), claim_batch_size=2)
+
+    result = orchestrator.process_reminders()
+
+    assert result['messages'] == 2
+    assert sorted(to for to, _ in backend.sent_messages) == ["+393330000001", "+393330000002"]
+
+
+def test_rate_limiter_is_shared_by_workers():
+    db_agent = FakeDatabaseAgent(make_reminders(11, due_date()))
+    backend = FakeBackend()
+    notification_agent = NotificationAgent(backend=backend)
+    orchestrator = make_orchestrator(db_agent, notification_agent, coalesce=False,
+                                     rate_limiter=TokenBucket(50, capacity=1))
+
+    started = time.perf_counter()
+    result = orchestrator.process_reminders()
+    elapsed = time.perf_counter() - started
+
+    assert result['sent'] == 11
+    # 1 token subito, poi 10 token a 50 al secondo
+    assert elapsed >= 0.18
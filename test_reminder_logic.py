@@ -0,0 +1,49 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from agents import ReminderLogicAgent
+
+
+def _sample_dates(today):
+    days = [today + timedelta(days=delta) for delta in range(-2, 10)]
+    return (
+        days
+        + [datetime.combine(day, datetime.min.time()) + timedelta(hours=15) for day in days]
+        + [day.isoformat() for day in days]
+        + ["2026-13-01", "17/10/2026", "", None]
+    )
+
+
+@pytest.mark.parametrize("lead_days", [0, 1, 3, 7])
+def test_due_offsets_matches_should_send_reminder(lead_days):
+    agent = ReminderLogicAgent(lead_days=lead_days)
+    today = datetime.now().date()
+    reminder_dates = _sample_dates(today)
+
+    offsets = agent.due_offsets(reminder_dates, offsets=[lead_days], today=today)
+
+    assert len(offsets) == len(reminder_dates)
+    for reminder_date, offset in zip(reminder_dates, offsets):
+        assert (offset is not None) == agent.should_send_reminder(reminder_date), reminder_date
+        assert offset in (None, lead_days)
+
+
+def test_due_offsets_returns_the_matching_offset():
+    agent = ReminderLogicAgent(offsets=[7, 30, 1])
+    today = date(2026, 10, 17)
+
+    offsets = agent.due_offsets(
+        [date(2026, 11, 16), "2026-10-24", datetime(2026, 10, 18, 9, 30), date(2026, 10, 20), "invalid"],
+        today=today
+    )
+
+    assert offsets == [30, 7, 1, None, None]
+
+
+def test_offsets_do_not_depend_on_configuration_order():
+    agent = ReminderLogicAgent(offsets=[1, 30, 7])
+
+    assert agent.offsets == (30, 7, 1)
+    assert agent.lead_days == 1
+    assert min(agent.due_dates(date(2026, 10, 17))) == date(2026, 10, 18)
@@ -0,0 +1,76 @@
+from datetime import date
+
+import pytest
+
+from sms_coalescing import coalesce_reminders, normalize_phone_number, render_message, sms_segments
+
+
+def make_reminder(reminder_id, phone_number, message="Revisione auto"):
+    return {'id': reminder_id, 'phone_number': phone_number, 'message': message, 'date': date(2026, 10, 20)}
+
+
+@pytest.mark.parametrize("length, segments", [(160, 1), (161, 2), (306, 2), (307, 3)])
+def test_gsm7_segment_limits(length, segments):
+    assert sms_segments("a" * length) == segments
+
+
+def test_gsm7_extended_characters_count_twice():
+    assert sms_segments("€" * 80) == 1
+    assert sms_segments("a" + "€" * 80) == 2
+
+
+@pytest.mark.parametrize("length, segments", [(70, 1), (71, 2), (134, 2), (135, 3)])
+def test_ucs2_segment_limits(length, segments):
+    # Un solo carattere fuori dall'alfabeto GSM (es. "ł") forza UCS-2 per tutto il testo
+    assert sms_segments("ł" + "a" * (length - 1)) == segments
+
+
+@pytest.mark.parametrize("raw, normalized", [
+    ("0039 333 123 4567", "+393331234567"),
+    (" +39 (333) 123-45.67 ", "+393331234567"),
+    ("3331234567", "3331234567"),
+    (None, ""),
+])
+def test_normalize_phone_number(raw, normalized):
+    assert normalize_phone_number(raw) == normalized
+
+
+def test_coalesce_groups_by_normalized_number():
+    reminders = [
+        make_reminder(1, "0039 333 1234567"),
+        make_reminder(2, "+39 02 1234567"),
+        make_reminder(3, "+393331234567"),
+    ]
+
+    messages = coalesce_reminders(reminders)
+
+    assert [(phone, [r['id'] for r in included]) for phone, _, included in messages] == [
+        ("+393331234567", [1, 3]),
+        ("+39021234567", [2]),
+    ]
+
+
+def test_coalesce_splits_at_max_segments():
+    reminders = [make_reminder(reminder_id, "+393331234567", "x" * 100) for reminder_id in range(1, 8)]
+
+    messages = coalesce_reminders(reminders, max_segments=2)
+
+    assert [r['id'] for _, _, included in messages for r in included] == list(range(1, 8))
+    assert len(messages) > 1
+    for _, body, _ in messages:
+        assert sms_segments(body) <= 2
+
+
+def test_single_reminder_over_limit_is_sent_alone():
+    messages = coalesce_reminders([make_reminder(1, "+393331234567", "x" * 500)], max_segments=1)
+
+    assert len(messages) == 1
+    assert sms_segments(messages[0][1]) > 1
+
+
+def test_coalesce_disabled_sends_one_message_per_reminder():
+    reminders = [make_reminder(1, "+393331234567"), make_reminder(2, "0039 333 1234567")]
+
+    messages = coalesce_reminders(reminders, coalesce=False)
+
+    assert [body for _, body, _ in messages] == [render_message(["Revisione auto (Data: 20/10/2026)"])] * 2